@@ -0,0 +1,30 @@
+"""add image_hash to messages
+
+Revision ID: 7c3e9a1d52f4
+Revises: 50ffda311919
+Create Date: 2026-10-17 10:12:31.402117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c3e9a1d52f4'
+down_revision: Union[str, Sequence[str], None] = '50ffda311919'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('messages', sa.Column('image_hash', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_messages_image_hash'), 'messages', ['image_hash'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_messages_image_hash'), table_name='messages')
+    op.drop_column('messages', 'image_hash')
@@ -0,0 +1,58 @@
+"""add message full text search
+
+Revision ID: a41f6d0c8e27
+Revises: 7c3e9a1d52f4
+Create Date: 2026-10-17 11:40:08.517730
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a41f6d0c8e27'
+down_revision: Union[str, Sequence[str], None] = '7c3e9a1d52f4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        # generated column, so edits re-index themselves and deletes take their entry with them
+        op.execute(
+            "ALTER TABLE messages ADD COLUMN search_vector tsvector "
+            "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED"
+        )
+        op.create_index('ix_messages_search_vector', 'messages', ['search_vector'], unique=False, postgresql_using='gin')
+        return
+
+    op.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(content, content='messages', content_rowid='id')")
+    op.execute(
+        "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END"
+    )
+    op.execute(
+        "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END"
+    )
+    op.execute(
+        "CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN "
+        "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+        "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END"
+    )
+    op.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_messages_search_vector', table_name='messages', postgresql_using='gin')
+        op.drop_column('messages', 'search_vector')
+        return
+
+    op.execute("DROP TRIGGER IF EXISTS messages_fts_update")
+    op.execute("DROP TRIGGER IF EXISTS messages_fts_delete")
+    op.execute("DROP TRIGGER IF EXISTS messages_fts_insert")
+    op.execute("DROP TABLE IF EXISTS messages_fts")
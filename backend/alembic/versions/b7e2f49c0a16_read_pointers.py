@@ -0,0 +1,44 @@
+"""read pointers
+
+Revision ID: b7e2f49c0a16
+Revises: f3a8c61d7e42
+Create Date: 2026-10-17 18:12:37.448190
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e2f49c0a16'
+down_revision: Union[str, Sequence[str], None] = 'f3a8c61d7e42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chat_participants', sa.Column('last_read_message_id', sa.Integer(), server_default='0', nullable=False))
+    # start from the old unread rule, everything up to the user's own last message counts as read
+    op.execute(
+        "UPDATE chat_participants SET last_read_message_id = COALESCE(("
+        "  SELECT MAX(m.id) FROM messages m"
+        "  WHERE m.chat_id = chat_participants.chat_id AND m.sender_id = chat_participants.user_id"
+        "), 0)"
+    )
+
+    if op.get_bind().dialect.name == 'postgresql':
+        # sender_id in the leaf pages makes the unread count an index-only scan
+        op.drop_index('ix_messages_chat_id_id', table_name='messages')
+        op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False, postgresql_include=['sender_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_messages_chat_id_id', table_name='messages')
+        op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False)
+
+    op.drop_column('chat_participants', 'last_read_message_id')
@@ -0,0 +1,70 @@
+"""hot path indexes and direct chats
+
+Revision ID: c82b5e4f19d3
+Revises: a41f6d0c8e27
+Create Date: 2026-10-17 13:05:52.274019
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c82b5e4f19d3'
+down_revision: Union[str, Sequence[str], None] = 'a41f6d0c8e27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # history pages, last message per chat and the per-user unread count
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False)
+    op.create_index('ix_messages_chat_id_sender_id_id', 'messages', ['chat_id', 'sender_id', 'id'], unique=False)
+
+    # senders of deleted users are kept as NULL instead of pointing at nothing
+    op.alter_column('messages', 'sender_id', existing_type=sa.Integer(), nullable=True)
+    op.execute("UPDATE messages SET sender_id = NULL WHERE sender_id NOT IN (SELECT id FROM users)")
+    op.create_foreign_key('fk_messages_sender_id_users', 'messages', 'users', ['sender_id'], ['id'], ondelete='SET NULL')
+
+    op.execute(
+        "DELETE FROM chat_participants WHERE id NOT IN "
+        "(SELECT MIN(id) FROM chat_participants GROUP BY user_id, chat_id)"
+    )
+    op.create_unique_constraint('uq_chat_participants_user_id_chat_id', 'chat_participants', ['user_id', 'chat_id'])
+    op.create_index('ix_chat_participants_chat_id', 'chat_participants', ['chat_id'], unique=False)
+
+    op.create_table(
+        'direct_chats',
+        sa.Column('user_low_id', sa.Integer(), nullable=False),
+        sa.Column('user_high_id', sa.Integer(), nullable=False),
+        sa.Column('chat_id', sa.Integer(), nullable=False),
+        sa.CheckConstraint('user_low_id < user_high_id', name='ck_direct_chats_ordered_pair'),
+        sa.ForeignKeyConstraint(['user_low_id'], ['users.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_high_id'], ['users.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_low_id', 'user_high_id'),
+        sa.UniqueConstraint('chat_id'),
+    )
+    # existing two-person chats become DMs, the oldest one wins if a pair has several
+    op.execute(
+        "INSERT INTO direct_chats (user_low_id, user_high_id, chat_id) "
+        "SELECT lo, hi, MIN(chat_id) FROM ("
+        "  SELECT chat_id, MIN(user_id) AS lo, MAX(user_id) AS hi FROM chat_participants"
+        "  GROUP BY chat_id HAVING COUNT(*) = 2 AND MIN(user_id) <> MAX(user_id)"
+        ") pairs GROUP BY lo, hi"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('direct_chats')
+    op.drop_index('ix_chat_participants_chat_id', table_name='chat_participants')
+    op.drop_constraint('uq_chat_participants_user_id_chat_id', 'chat_participants', type_='unique')
+    op.drop_constraint('fk_messages_sender_id_users', 'messages', type_='foreignkey')
+    op.execute("DELETE FROM messages WHERE sender_id IS NULL")
+    op.alter_column('messages', 'sender_id', existing_type=sa.Integer(), nullable=False)
+    op.drop_index('ix_messages_chat_id_sender_id_id', table_name='messages')
+    op.drop_index('ix_messages_chat_id_id', table_name='messages')
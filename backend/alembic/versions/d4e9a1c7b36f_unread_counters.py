@@ -0,0 +1,36 @@
+"""unread counters
+
+Revision ID: d4e9a1c7b36f
+Revises: b7e2f49c0a16
+Create Date: 2026-10-17 20:31:05.218734
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4e9a1c7b36f'
+down_revision: Union[str, Sequence[str], None] = 'b7e2f49c0a16'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chat_participants', sa.Column('unread_count', sa.Integer(), server_default='0', nullable=False))
+    # counted once here, from then on every write keeps the counter in step
+    op.execute(
+        "UPDATE chat_participants SET unread_count = ("
+        "  SELECT COUNT(*) FROM messages m"
+        "  WHERE m.chat_id = chat_participants.chat_id AND m.id > chat_participants.last_read_message_id"
+        "  AND (m.sender_id IS NULL OR m.sender_id <> chat_participants.user_id)"
+        ")"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('chat_participants', 'unread_count')
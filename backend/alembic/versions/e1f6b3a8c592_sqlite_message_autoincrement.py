@@ -0,0 +1,61 @@
+"""sqlite message autoincrement
+
+Revision ID: e1f6b3a8c592
+Revises: d4e9a1c7b36f
+Create Date: 2026-10-17 22:04:51.637120
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e1f6b3a8c592'
+down_revision: Union[str, Sequence[str], None] = 'd4e9a1c7b36f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+FTS_TRIGGERS = [
+    "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+
+
+def recreate_messages(autoincrement: bool) -> None:
+    # SQLite can only change AUTOINCREMENT by rebuilding the table, which drops its triggers
+    with op.batch_alter_table('messages', recreate='always', table_kwargs={'sqlite_autoincrement': autoincrement}):
+        pass
+    for trigger in FTS_TRIGGERS:
+        op.execute(trigger)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Postgres sequences never hand an id out twice
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    recreate_messages(True)
+    # ids of newest messages deleted before this ran are still named by the change log, they must not come back either
+    op.execute(
+        "UPDATE sqlite_sequence SET seq = max(seq, COALESCE((SELECT MAX(message_id) FROM chat_changes), 0)) "
+        "WHERE name = 'messages'"
+    )
+    op.execute(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'messages', MAX(message_id) FROM chat_changes "
+        "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'messages') HAVING MAX(message_id) IS NOT NULL"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    recreate_messages(False)
@@ -0,0 +1,52 @@
+"""chat change log
+
+Revision ID: e5b7d2a90c31
+Revises: c82b5e4f19d3
+Create Date: 2026-10-17 15:42:18.603117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5b7d2a90c31'
+down_revision: Union[str, Sequence[str], None] = 'c82b5e4f19d3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chats', sa.Column('last_seq', sa.Integer(), server_default='0', nullable=False))
+    op.create_table(
+        'chat_changes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('chat_id', sa.Integer(), nullable=False),
+        sa.Column('seq', sa.Integer(), nullable=False),
+        sa.Column('message_id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=16), nullable=False),
+        sa.Column('changed_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('chat_id', 'seq', name='uq_chat_changes_chat_id_seq'),
+    )
+
+    # existing history becomes one create per message, numbered in id order within each chat
+    op.execute(
+        "INSERT INTO chat_changes (chat_id, seq, message_id, kind, changed_at) "
+        "SELECT chat_id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id), id, 'create', sent_time "
+        "FROM messages"
+    )
+    op.execute(
+        "UPDATE chats SET last_seq = "
+        "(SELECT COUNT(*) FROM chat_changes WHERE chat_changes.chat_id = chats.id)"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('chat_changes')
+    op.drop_column('chats', 'last_seq')
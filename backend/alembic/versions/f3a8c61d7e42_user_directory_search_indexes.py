@@ -0,0 +1,43 @@
+"""user directory search indexes
+
+Revision ID: f3a8c61d7e42
+Revises: e5b7d2a90c31
+Create Date: 2026-10-17 16:48:21.903517
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3a8c61d7e42'
+down_revision: Union[str, Sequence[str], None] = 'e5b7d2a90c31'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # SQLite has no trigram or pattern_ops index, the directory search scans users there
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # substring LIKEs on 3+ characters
+    op.execute("CREATE INDEX ix_users_username_trgm ON users USING gin (lower(username) gin_trgm_ops)")
+    op.execute("CREATE INDEX ix_users_display_name_trgm ON users USING gin (lower(display_name) gin_trgm_ops)")
+    # 'q%' prefix LIKEs, usable whatever the database collation is
+    op.execute("CREATE INDEX ix_users_username_prefix ON users (lower(username) text_pattern_ops)")
+    op.execute("CREATE INDEX ix_users_display_name_prefix ON users (lower(display_name) text_pattern_ops)")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.drop_index('ix_users_display_name_prefix', table_name='users')
+    op.drop_index('ix_users_username_prefix', table_name='users')
+    op.drop_index('ix_users_display_name_trgm', table_name='users')
+    op.drop_index('ix_users_username_trgm', table_name='users')
@@ -1,11 +1,13 @@
 from fastapi import Request, HTTPException, status, Depends
+from sqlalchemy import select
 
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import jwt
 import os
 
-from database import get_db, User
+from database import get_db, AsyncSessionLocal, User
+from auth_cache import auth_cache, UserSnapshot
 
 
 load_dotenv()
@@ -23,7 +25,7 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     return encoded_jwt
 
 
-def get_current_user(request: Request, db=Depends(get_db)):
+async def get_current_user(request: Request, db=Depends(get_db)):
     auth_header = request.headers.get("Authorization")
 
     if not auth_header or not auth_header.startswith("Bearer "):
@@ -31,6 +33,23 @@ def get_current_user(request: Request, db=Depends(get_db)):
 
     token = auth_header.split(" ")[1]
 
+    return await authenticate_token(token, db)
+
+
+async def authenticate_websocket(token: str | None):
+    if not token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing or invalid token")
+
+    # the session only checks out a connection if the token is not cached
+    async with AsyncSessionLocal() as db:
+        return await authenticate_token(token, db)
+
+
+async def authenticate_token(token: str, db):
+    cached = auth_cache.get(token)
+    if cached is not None:
+        return cached
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username = payload.get("sub")
@@ -44,9 +63,12 @@ def get_current_user(request: Request, db=Depends(get_db)):
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
-    user = db.query(User).filter(User.username == username).first()
+    user = await db.scalar(select(User).where(User.username == username))
 
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
 
-    return user
+    snapshot = UserSnapshot.from_user(user)
+    auth_cache.set(token, snapshot, payload.get("exp"))
+
+    return snapshot
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import os
+import threading
+import time
+
+
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", 10000))
+# deletions reach every worker over the broker, this bounds how long a token outlives a user whose event was missed
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", 60))
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    id: int
+    username: str
+    display_name: str | None
+    email: str
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(id=user.id, username=user.username, display_name=user.display_name, email=user.email)
+
+
+class AuthCache:
+    def __init__(self, max_size: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # token -> (snapshot, expires_at), least recently used first
+        self._tokens: OrderedDict[str, tuple[UserSnapshot, float]] = OrderedDict()
+        self._user_tokens: dict[int, set[str]] = {}
+
+    def get(self, token: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            snapshot, expires_at = entry
+            if expires_at <= now:
+                self._drop(token)
+                self.misses += 1
+                return None
+
+            self._tokens.move_to_end(token)
+            self.hits += 1
+            return snapshot
+
+    def set(self, token: str, snapshot: UserSnapshot, token_exp: float | None = None):
+        ttl = self.ttl
+        if token_exp is not None:
+            ttl = min(ttl, token_exp - time.time())
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._drop(token)
+            self._tokens[token] = (snapshot, time.monotonic() + ttl)
+            self._user_tokens.setdefault(snapshot.id, set()).add(token)
+
+            while len(self._tokens) > self.max_size:
+                self._drop(next(iter(self._tokens)))
+                self.evictions += 1
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for token in list(self._user_tokens.get(user_id, ())):
+                self._drop(token)
+
+    def listen(self, events):
+        # a user deleted on another worker stops authenticating here without waiting for the TTL
+        events.on("user_removed", lambda chat_id, event: self.invalidate_user(event["user_id"]))
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+            self._user_tokens.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._tokens), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def _drop(self, token: str):
+        entry = self._tokens.pop(token, None)
+        if entry is None:
+            return
+        tokens = self._user_tokens.get(entry[0].id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._user_tokens[entry[0].id]
+
+
+auth_cache = AuthCache()
@@ -0,0 +1,471 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+BENCH_PASSWORD = "bench-password"
+SCENARIOS = ("login", "send", "history", "history_older", "chat_list", "ws_fanout")
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    # nearest rank, so every reported value is one that was actually measured
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies: list[float], errors: int, seconds: float) -> dict:
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "seconds": round(seconds, 4),
+        "throughput_rps": round(len(values) / seconds, 2) if seconds else 0.0,
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+async def run_load(requests: int, concurrency: int, operation) -> dict:
+    latencies, errors = [], 0
+    indexes = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in indexes:
+            started = time.perf_counter()
+            try:
+                await operation(i)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def configure_env(args):
+    # the app reads its settings at import time, so they have to be in place before anything is imported
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret-key-benchmark-secret-key")
+    if args.bcrypt_rounds:
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+
+
+async def seed(args) -> dict:
+    from sqlalchemy import func, insert, select
+
+    import bcrypt
+
+    import database
+    from database import User, Chat, ChatParticipant, DirectChat
+    from history import import_batch, IMPORT_BATCH_SIZE
+    from passwords import BCRYPT_ROUNDS
+
+    if args.reset:
+        database.Base.metadata.drop_all(bind=database.engine)
+    database.init_db()
+
+    with database.engine.begin() as connection:
+        if connection.scalar(select(func.count()).select_from(User)):
+            raise SystemExit("Benchmark database is not empty, pass --reset to recreate it")
+
+        password = bcrypt.hashpw(BENCH_PASSWORD.encode(), bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
+        usernames = [f"bench{i}" for i in range(args.users)]
+        user_ids = connection.execute(
+            insert(User).returning(User.id, sort_by_parameter_order=True),
+            [{"username": name, "display_name": name.title(), "email": f"{name}@bench.local", "password": password} for name in usernames],
+        ).scalars().all()
+
+        # DMs between distinct pairs, spread so every user ends up in a similar number of chats
+        pairs = []
+        for step in range(1, args.users):
+            for low in range(args.users):
+                high = (low + step) % args.users
+                pair = tuple(sorted((user_ids[low], user_ids[high])))
+                if pair not in pairs:
+                    pairs.append(pair)
+                if len(pairs) == args.chats:
+                    break
+            if len(pairs) == args.chats:
+                break
+
+        chat_ids = connection.execute(
+            insert(Chat).returning(Chat.id, sort_by_parameter_order=True), [{"last_seq": 0} for _ in pairs]
+        ).scalars().all()
+        connection.execute(insert(DirectChat), [
+            {"user_low_id": low, "user_high_id": high, "chat_id": chat_id} for chat_id, (low, high) in zip(chat_ids, pairs)
+        ])
+        connection.execute(insert(ChatParticipant), [
+            {"chat_id": chat_id, "user_id": user_id} for chat_id, pair in zip(chat_ids, pairs) for user_id in pair
+        ])
+
+    names = dict(zip(user_ids, usernames))
+    filler = "lorem ipsum dolor sit amet " * (args.message_length // 27 + 1)
+    started = datetime.utcnow() - timedelta(days=30)
+
+    async with database.AsyncSessionLocal() as db:
+        sender_ids = {}
+        for chat_id, pair in zip(chat_ids, pairs):
+            for offset in range(0, args.history, IMPORT_BATCH_SIZE):
+                batch = [
+                    {
+                        "chat_id": chat_id,
+                        "sender_username": names[pair[i % 2]],
+                        "content": f"{i} {filler}"[:args.message_length],
+                        "reply_content": None,
+                        "image_url": None,
+                        "image_hash": None,
+                        "sent_time": started + timedelta(seconds=i),
+                    }
+                    for i in range(offset, min(offset + IMPORT_BATCH_SIZE, args.history))
+                ]
+                await import_batch(db, chat_id, batch, sender_ids)
+    await database.async_engine.dispose()
+
+    return {
+        "users": [{"id": user_id, "username": names[user_id]} for user_id in user_ids],
+        "chats": [{"id": chat_id, "participants": list(pair)} for chat_id, pair in zip(chat_ids, pairs)],
+    }
+
+
+class Workload:
+    def __init__(self, args, dataset: dict):
+        from auth import create_access_token
+
+        self.args = args
+        self.chats = dataset["chats"]
+        self.users = dataset["users"]
+        self.usernames = {user["id"]: user["username"] for user in self.users}
+        self.tokens = {
+            user["id"]: create_access_token(data={"sub": user["username"]}, expires_delta=timedelta(hours=12))
+            for user in self.users
+        }
+        self.random = random.Random(args.seed)
+
+    def headers(self, user_id: int) -> dict:
+        return {"Authorization": f"Bearer {self.tokens[user_id]}"}
+
+    def pick(self):
+        chat = self.random.choice(self.chats)
+        return chat["id"], self.random.choice(chat["participants"])
+
+    async def run(self, client, websocket_factory) -> dict:
+        args = self.args
+        results = {}
+
+        async def login(_):
+            user = self.random.choice(self.users)
+            response = await client.post("/login", json={"username": user["username"], "password": BENCH_PASSWORD})
+            response.raise_for_status()
+
+        async def send(i):
+            chat_id, user_id = self.pick()
+            response = await client.post("/messages", data={"chat_id": chat_id, "content": f"bench send {i}"}, headers=self.headers(user_id))
+            response.raise_for_status()
+
+        async def history(_):
+            chat_id, user_id = self.pick()
+            response = await client.get("/messages", params={"chat_id": chat_id}, headers=self.headers(user_id))
+            response.raise_for_status()
+
+        async def history_older(_):
+            # a page from deep in the history, always read from the database
+            chat_id, user_id = self.pick()
+            before_id = self.random.randint(1, max(1, len(self.chats) * args.history))
+            response = await client.get("/messages", params={"chat_id": chat_id, "before_id": before_id}, headers=self.headers(user_id))
+            response.raise_for_status()
+
+        async def chat_list(_):
+            _, user_id = self.pick()
+            response = await client.get("/chats", headers=self.headers(user_id))
+            response.raise_for_status()
+
+        operations = {
+            "login": (login, args.login_requests),
+            "send": (send, args.requests),
+            "history": (history, args.requests),
+            "history_older": (history_older, args.requests),
+            "chat_list": (chat_list, args.requests),
+        }
+        for name, (operation, requests) in operations.items():
+            if name not in args.scenarios:
+                continue
+            await run_load(min(args.warmup, requests), args.concurrency, operation)
+            results[name] = await run_load(requests, args.concurrency, operation)
+            print(f"  {name:<14} {format_result(results[name])}", file=sys.stderr)
+
+        if "ws_fanout" in args.scenarios:
+            results["ws_fanout"] = await self.fanout(client, websocket_factory)
+            print(f"  {'ws_fanout':<14} {format_result(results['ws_fanout'])}", file=sys.stderr)
+
+        return results
+
+    async def fanout(self, client, websocket_factory) -> dict:
+        # every subscriber sits in the same chat, spread over its two participants like several open tabs
+        args = self.args
+        chat = self.chats[0]
+        rounds: dict[str, list] = {}
+
+        def received(content):
+            state = rounds.get(content)
+            if state is None:
+                return
+            state[1] -= 1
+            if state[1] == 0:
+                state[2].set_result(time.perf_counter())
+
+        subscribers = []
+        for i in range(args.subscribers):
+            user_id = chat["participants"][i % 2]
+            subscribers.append(await websocket_factory(chat["id"], self.tokens[user_id], received))
+
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        try:
+            for i in range(args.fanout_messages):
+                content = f"bench fanout {i}"
+                done = asyncio.get_running_loop().create_future()
+                rounds[content] = [None, args.subscribers, done]
+
+                sent = time.perf_counter()
+                response = await client.post(
+                    "/messages", data={"chat_id": chat["id"], "content": content}, headers=self.headers(chat["participants"][0])
+                )
+                try:
+                    response.raise_for_status()
+                    latencies.append(await asyncio.wait_for(done, args.fanout_timeout) - sent)
+                except Exception:
+                    errors += 1
+                rounds.pop(content, None)
+        finally:
+            for close in subscribers:
+                await close()
+
+        result = summarize(latencies, errors, time.perf_counter() - started)
+        result["subscribers"] = args.subscribers
+        result["deliveries_per_second"] = round(result["throughput_rps"] * args.subscribers, 2)
+        return result
+
+
+class BenchWebSocket:
+    # stands in for a client socket in process, ConnectionManager only needs these few calls
+    def __init__(self, on_message):
+        self.scope = {"subprotocols": []}
+        self.on_message = on_message
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        self.on_message(json.loads(data).get("content"))
+
+    async def send_bytes(self, data: bytes):
+        import msgpack
+
+        self.on_message(msgpack.unpackb(data).get("content"))
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+async def run_inprocess(args, workload: Workload) -> dict:
+    import httpx
+
+    from main import app
+    from websocket import manager
+
+    async def websocket_factory(chat_id, token, received):
+        websocket = BenchWebSocket(received)
+        connection = await manager.connect(chat_id, websocket)
+        return lambda: asyncio.sleep(0, manager.disconnect(connection))
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            return await workload.run(client, websocket_factory)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_socket(args, workload: Workload) -> dict:
+    import httpx
+    import websockets
+
+    port = args.port or free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--ws", "websockets", "--log-level", "warning"],
+        cwd=Path(__file__).resolve().parent,
+        env=os.environ.copy(),
+    )
+    base_url = f"http://127.0.0.1:{port}"
+
+    async def websocket_factory(chat_id, token, received):
+        connection = await websockets.connect(f"ws://127.0.0.1:{port}/ws/chat/{chat_id}?token={token}", max_queue=None)
+
+        async def read():
+            async for frame in connection:
+                received(json.loads(frame).get("content"))
+
+        reader = asyncio.create_task(read())
+
+        async def close():
+            reader.cancel()
+            await connection.close()
+
+        return close
+
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+            for _ in range(100):
+                try:
+                    await client.get("/openapi.json")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise SystemExit("Benchmark server did not start")
+
+            return await workload.run(client, websocket_factory)
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+
+def format_result(result: dict) -> str:
+    return (
+        f"{result['throughput_rps']:>9.1f} req/s  p50 {result['p50_ms']:>8.2f} ms  "
+        f"p95 {result['p95_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms  errors {result['errors']}"
+    )
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    print(f"\n{'mode':<10} {'scenario':<14} {'p95 ms':>20} {'req/s':>20}", file=sys.stderr)
+    for mode, scenarios in current["results"].items():
+        for name, result in scenarios.items():
+            base = baseline.get("results", {}).get(mode, {}).get(name)
+            if base is None:
+                continue
+
+            p95_change = (result["p95_ms"] - base["p95_ms"]) / base["p95_ms"] if base["p95_ms"] else 0.0
+            rps_change = (result["throughput_rps"] - base["throughput_rps"]) / base["throughput_rps"] if base["throughput_rps"] else 0.0
+            flag = ""
+            if p95_change > threshold or rps_change < -threshold:
+                flag = "  REGRESSION"
+                regressions.append(f"{mode}/{name}")
+            print(
+                f"{mode:<10} {name:<14} {base['p95_ms']:>8.2f} -> {result['p95_ms']:>8.2f} "
+                f"{base['throughput_rps']:>8.1f} -> {result['throughput_rps']:>8.1f} "
+                f"({p95_change:+.0%} p95, {rps_change:+.0%} req/s){flag}",
+                file=sys.stderr,
+            )
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).resolve().parent
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def run(args) -> dict:
+    dataset = await seed(args)
+    workload = Workload(args, dataset)
+
+    report = {
+        "meta": {
+            "started_at": datetime.utcnow().isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "database": args.database_url.split(":", 1)[0],
+            "config": {key: value for key, value in vars(args).items() if key not in ("database_url", "output", "baseline")},
+        },
+        "results": {},
+    }
+
+    for mode in ("inprocess", "socket"):
+        if args.mode in (mode, "both"):
+            print(f"{mode}:", file=sys.stderr)
+            runner = run_inprocess if mode == "inprocess" else run_socket
+            report["results"][mode] = await runner(args, workload)
+    return report
+
+
+def main():
+    default_db = Path(tempfile.gettempdir()) / "mocqa-bench.db"
+
+    parser = argparse.ArgumentParser(description="Seed a local database and benchmark the REST and websocket paths")
+    parser.add_argument("--database-url", default=f"sqlite:///{default_db}")
+    parser.add_argument("--reset", action="store_true", help="drop and recreate every table before seeding")
+    parser.add_argument("--mode", choices=("inprocess", "socket", "both"), default="both")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--history", type=int, default=1000, help="messages seeded per chat")
+    parser.add_argument("--message-length", type=int, default=80)
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--login-requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--subscribers", type=int, default=100, help="websocket subscribers for ws_fanout")
+    parser.add_argument("--fanout-messages", type=int, default=100)
+    parser.add_argument("--fanout-timeout", type=float, default=10)
+    parser.add_argument("--bcrypt-rounds", type=int, help="work factor for seeded passwords and the server")
+    parser.add_argument("--port", type=int, help="port for the socket mode server, a free one by default")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="write the JSON report here, - for stdout")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative p95 or throughput change counted as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    if args.users < 2 or args.chats > args.users * (args.users - 1) // 2:
+        parser.error("need at least 2 users and no more chats than distinct user pairs")
+
+    if args.reset and args.database_url == f"sqlite:///{default_db}" and default_db.exists():
+        default_db.unlink()
+
+    configure_env(args)
+    report = asyncio.run(run(args))
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+    elif args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions and args.fail_on_regression:
+            parser.exit(1, f"Regressions: {', '.join(regressions)}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+from sqlalchemy import select
+
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import deque
+from dotenv import load_dotenv
+
+from database import AsyncSessionLocal, Message
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+WS_BROKER = os.getenv("WS_BROKER", "memory")
+BROKER_BATCH_SIZE = int(os.getenv("BROKER_BATCH_SIZE", 100))
+BROKER_BATCH_INTERVAL = float(os.getenv("BROKER_BATCH_INTERVAL_MS", 5)) / 1000
+BROKER_POLL_INTERVAL = float(os.getenv("BROKER_POLL_INTERVAL_MS", 100)) / 1000
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+NOTIFY_PAYLOAD_LIMIT = 7900
+
+# event fields a receiver can load back from the messages row, by event action: (id field, {event field: column})
+# an event too large for NOTIFY goes out without them and is completed on arrival
+REFERENCE_FIELDS = {
+    None: ("id", {"content": Message.content, "reply_content": Message.reply_content}),
+    "edit_message": ("message_id", {"new_content": Message.content}),
+}
+
+
+# A broker carries broadcasts between nodes. The ConnectionManager delivers to its own sockets,
+# so a broker only has to hand events published on other nodes to ``handler``.
+class Broker:
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex
+        self.subscriptions: set[int] = set()
+        self.handler = None
+
+    async def start(self, handler):
+        self.handler = handler
+
+    async def stop(self):
+        self.handler = None
+
+    def subscribe(self, chat_id: int):
+        self.subscriptions.add(chat_id)
+
+    def unsubscribe(self, chat_id: int):
+        self.subscriptions.discard(chat_id)
+
+    async def publish(self, chat_id: int, message: dict, coalesce_key=None, ephemeral: bool = False, skip_user: int | None = None):
+        raise NotImplementedError
+
+
+class InMemoryBroker(Broker):
+    def __init__(self, bus: list | None = None):
+        super().__init__()
+        # brokers sharing one bus see each other's publishes, a lone broker is a single node
+        self.bus = bus if bus is not None else []
+
+    async def start(self, handler):
+        await super().start(handler)
+        self.bus.append(self)
+
+    async def stop(self):
+        if self in self.bus:
+            self.bus.remove(self)
+        await super().stop()
+
+    async def publish(self, chat_id: int, message: dict, coalesce_key=None, ephemeral: bool = False, skip_user: int | None = None):
+        for peer in self.bus:
+            if peer is not self and peer.handler and chat_id in peer.subscriptions:
+                peer.handler(chat_id, message, coalesce_key, ephemeral, skip_user)
+
+
+class PostgresBroker(Broker):
+    def __init__(
+        self,
+        conninfo: str,
+        batch_size: int = BROKER_BATCH_SIZE,
+        batch_interval: float = BROKER_BATCH_INTERVAL,
+        poll_interval: float = BROKER_POLL_INTERVAL,
+    ):
+        super().__init__()
+        self.conninfo = conninfo
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.poll_interval = poll_interval
+        self.listening: set[int] = set()
+        # chat_id -> events waiting behind a reference being loaded, so the chat keeps its order
+        self._held: dict[int, deque] = {}
+        self._releases: set[asyncio.Task] = set()
+        self._pending: list[tuple] = []
+        self._has_pending = asyncio.Event()
+        self._listen_conn = None
+        self._notify_conn = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self, handler):
+        await super().start(handler)
+        self._listen_conn = await self._connect()
+        self._notify_conn = await self._connect()
+        self._tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._flush_loop())]
+
+    async def stop(self):
+        tasks = [*self._tasks, *self._releases]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+
+        if self._pending and self._notify_conn is not None:
+            await self._flush()
+
+        for conn in (self._listen_conn, self._notify_conn):
+            if conn is not None:
+                await conn.close()
+        self._listen_conn = self._notify_conn = None
+        self.listening.clear()
+        await super().stop()
+
+    async def publish(self, chat_id: int, message: dict, coalesce_key=None, ephemeral: bool = False, skip_user: int | None = None):
+        self._pending.append((chat_id, message, coalesce_key, ephemeral, skip_user))
+        self._has_pending.set()
+
+    async def _connect(self):
+        import psycopg
+
+        return await psycopg.AsyncConnection.connect(self.conninfo, autocommit=True)
+
+    async def _listen(self):
+        while True:
+            try:
+                await self._sync_channels()
+                # LISTEN/UNLISTEN can only run between notifies() rounds, so rounds are kept short
+                async for notify in self._listen_conn.notifies(timeout=self.poll_interval):
+                    self._dispatch(notify.channel, notify.payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Broker listener failed, reconnecting")
+                self.listening.clear()
+                await asyncio.sleep(1)
+                try:
+                    self._listen_conn = await self._connect()
+                except Exception:
+                    logger.exception("Broker listener reconnect failed")
+
+    async def _sync_channels(self):
+        from psycopg import sql
+
+        for chat_id in self.subscriptions - self.listening:
+            await self._listen_conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel_name(chat_id))))
+            self.listening.add(chat_id)
+
+        for chat_id in self.listening - self.subscriptions:
+            await self._listen_conn.execute(sql.SQL("UNLISTEN {}").format(sql.Identifier(channel_name(chat_id))))
+            self.listening.discard(chat_id)
+
+    def _dispatch(self, channel: str, payload: str):
+        data = json.loads(payload)
+        if data["n"] == self.node_id or self.handler is None:
+            return
+
+        chat_id = int(channel.removeprefix("chat_"))
+        if chat_id not in self.subscriptions:
+            return
+
+        # events from nodes that predate the ephemeral flag only carry [message, coalesce_key],
+        # a fourth element is the id of the message to load the event's large fields from,
+        # a fifth the user whose own sockets don't get the event
+        for message, coalesce_key, *rest in data["e"]:
+            coalesce_key = tuple(coalesce_key) if isinstance(coalesce_key, list) else coalesce_key
+            ephemeral = bool(rest and rest[0])
+            reference = rest[1] if len(rest) > 1 else None
+            skip_user = rest[2] if len(rest) > 2 else None
+
+            held = self._held.get(chat_id)
+            if held is None and reference is None:
+                self.handler(chat_id, message, coalesce_key, ephemeral, skip_user)
+                continue
+
+            if held is None:
+                held = self._held[chat_id] = deque()
+                task = asyncio.create_task(self._release(chat_id, held))
+                self._releases.add(task)
+                task.add_done_callback(self._releases.discard)
+            held.append((message, coalesce_key, ephemeral, reference, skip_user))
+
+    async def _release(self, chat_id: int, held: deque):
+        try:
+            while held:
+                message, coalesce_key, ephemeral, reference, skip_user = held[0]
+                if reference is not None:
+                    message = await self._load_reference(message, reference)
+                held.popleft()
+                if message is not None and self.handler is not None:
+                    self.handler(chat_id, message, coalesce_key, ephemeral, skip_user)
+        finally:
+            del self._held[chat_id]
+
+    async def _load_reference(self, message: dict, message_id: int):
+        _, fields = REFERENCE_FIELDS[message.get("action")]
+        try:
+            async with AsyncSessionLocal() as db:
+                row = (await db.execute(select(*fields.values()).where(Message.id == message_id))).first()
+        except Exception:
+            logger.exception("Failed to load message %s for a broadcast", message_id)
+            return None
+
+        # deleted since, its delete event follows
+        if row is None:
+            return None
+        return {**message, **dict(zip(fields, row))}
+
+    async def _flush_loop(self):
+        while True:
+            await self._has_pending.wait()
+            if len(self._pending) < self.batch_size:
+                await asyncio.sleep(self.batch_interval)
+
+            try:
+                await self._flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Broker publish failed, reconnecting")
+                try:
+                    self._notify_conn = await self._connect()
+                except Exception:
+                    logger.exception("Broker publisher reconnect failed")
+                    await asyncio.sleep(1)
+
+    async def _flush(self):
+        batch, self._pending = self._pending, []
+        self._has_pending.clear()
+
+        channels, payloads = self._pack(batch)
+        if channels:
+            # one round trip for the whole batch, unnest keeps the publish order
+            await self._notify_conn.execute(
+                "SELECT pg_notify(c, p) FROM unnest(%s::text[], %s::text[]) AS t(c, p)",
+                (channels, payloads),
+            )
+
+    def _pack(self, batch: list[tuple]):
+        channels, payloads = [], []
+        open_chat, events, size = None, [], 0
+
+        def close():
+            if events:
+                channels.append(channel_name(open_chat))
+                payloads.append(json.dumps({"n": self.node_id, "e": events}, ensure_ascii=False, default=str))
+
+        # ordering only matters within a chat, so each chat's events share as few payloads as possible
+        by_chat: dict[int, list] = {}
+        for chat_id, message, coalesce_key, ephemeral, skip_user in batch:
+            event = [message, coalesce_key, ephemeral]
+            if skip_user is not None:
+                event += [None, skip_user]
+            by_chat.setdefault(chat_id, []).append(event)
+
+        for chat_id, chat_events in by_chat.items():
+            for event in chat_events:
+                event_size = encoded_size(event)
+                if event_size + 64 > NOTIFY_PAYLOAD_LIMIT:
+                    event = reference_event(event)
+                    event_size = encoded_size(event) if event else 0
+                    if event is None or event_size + 64 > NOTIFY_PAYLOAD_LIMIT:
+                        logger.warning("Broadcast for chat %s is too large for NOTIFY, delivered locally only", chat_id)
+                        continue
+
+                if chat_id != open_chat or size + event_size + 64 > NOTIFY_PAYLOAD_LIMIT:
+                    close()
+                    open_chat, events, size = chat_id, [], 0
+
+                events.append(event)
+                size += event_size + 1
+
+        close()
+        return channels, payloads
+
+
+def encoded_size(event) -> int:
+    return len(json.dumps(event, ensure_ascii=False, default=str).encode())
+
+
+def reference_event(event: list):
+    # the event without its reloadable fields plus the id to load them by, None when it has none
+    message, coalesce_key, ephemeral, *rest = event
+    if not isinstance(message, dict) or message.get("action") not in REFERENCE_FIELDS:
+        return None
+
+    id_field, fields = REFERENCE_FIELDS[message.get("action")]
+    if not isinstance(message.get(id_field), int):
+        return None
+    return [{**message, **dict.fromkeys(fields)}, coalesce_key, ephemeral, message[id_field], *rest[1:]]
+
+
+def channel_name(chat_id: int) -> str:
+    return f"chat_{chat_id}"
+
+
+def to_libpq_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    return scheme.split("+")[0] + sep + rest
+
+
+def create_broker() -> Broker:
+    if WS_BROKER == "postgres":
+        return PostgresBroker(to_libpq_url(os.getenv("BROKER_DATABASE_URL") or os.getenv("DATABASE_URL")))
+    if WS_BROKER == "memory":
+        return InMemoryBroker()
+    raise ValueError(f"Unknown websocket broker: {WS_BROKER}")
@@ -0,0 +1,62 @@
+from sqlalchemy import case, insert, update
+
+from datetime import datetime
+
+from database import Chat, ChatChange, ChatParticipant
+
+
+CHANGE_CREATE = "create"
+CHANGE_EDIT = "edit"
+CHANGE_DELETE = "delete"
+
+
+async def record_changes(db, chat_id: int, changes: list[tuple[int, str]]) -> list[int]:
+    # runs in the caller's transaction, the UPDATE holds the chat row until commit
+    # so seqs become visible in the order they were handed out
+    last_seq = await db.scalar(
+        update(Chat)
+        .where(Chat.id == chat_id)
+        .values(last_seq=Chat.last_seq + len(changes))
+        .returning(Chat.last_seq)
+        .execution_options(synchronize_session=False)
+    )
+    seqs = list(range(last_seq - len(changes) + 1, last_seq + 1))
+
+    now = datetime.utcnow()
+    await db.execute(insert(ChatChange), [
+        {"chat_id": chat_id, "seq": seq, "message_id": message_id, "kind": kind, "changed_at": now}
+        for seq, (message_id, kind) in zip(seqs, changes)
+    ])
+    return seqs
+
+
+async def add_unread(db, chat_id: int, sender_ids: list[int | None]):
+    # in the caller's transaction, each participant gains the new messages someone else sent
+    own = {}
+    for sender_id in sender_ids:
+        if sender_id is not None:
+            own[sender_id] = own.get(sender_id, 0) + 1
+    added = len(sender_ids)
+    if own:
+        added = case({user_id: len(sender_ids) - count for user_id, count in own.items()}, value=ChatParticipant.user_id, else_=len(sender_ids))
+    await db.execute(
+        update(ChatParticipant)
+        .where(ChatParticipant.chat_id == chat_id)
+        .values(unread_count=ChatParticipant.unread_count + added)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def remove_unread(db, chat_id: int, message_id: int, sender_id: int | None):
+    # in the caller's transaction, a deleted message stops counting for whoever hadn't read it
+    await db.execute(
+        update(ChatParticipant)
+        .where(
+            ChatParticipant.chat_id == chat_id,
+            ChatParticipant.user_id.is_distinct_from(sender_id),
+            ChatParticipant.last_read_message_id < message_id,
+            ChatParticipant.unread_count > 0,
+        )
+        .values(unread_count=ChatParticipant.unread_count - 1)
+        .execution_options(synchronize_session=False)
+    )
@@ -0,0 +1,212 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+import weakref
+
+from remote_events import MESSAGE_CREATED
+
+
+CHAT_LIST_CACHE_USERS = int(os.getenv("CHAT_LIST_CACHE_USERS", 10000))
+# a list cached for a user with no socket here misses other workers' events for their chats, this bounds how stale it gets
+CHAT_LIST_CACHE_TTL = float(os.getenv("CHAT_LIST_CACHE_TTL", 10))
+
+
+def message_summary(msg):
+    return {
+        "id": msg.id,
+        "chat_id": msg.chat_id,
+        "sender_id": msg.sender_id,
+        "content": msg.content,
+        "image_url": msg.image_url,
+        "sent_time": msg.sent_time.isoformat() if msg.sent_time else None,
+    }
+
+
+class ChatListFill:
+    # a list load in flight, writes landing meanwhile are noted so a list missing them isn't cached
+    __slots__ = ("user_id", "chat_ids", "stale", "__weakref__")
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.chat_ids: set[int] = set()
+        self.stale = False
+
+
+class ChatListCache:
+    def __init__(self, max_users: int = CHAT_LIST_CACHE_USERS, ttl: float = CHAT_LIST_CACHE_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # user_id -> {chat_id: entry}, least recently used first
+        self._users: OrderedDict[int, dict[int, dict]] = OrderedDict()
+        self._expires: dict[int, float] = {}
+        # chat_id -> user_ids whose cached list contains the chat
+        self._chat_users: dict[int, set[int]] = {}
+        # weak, a load that failed halfway just drops out
+        self._fills: weakref.WeakSet[ChatListFill] = weakref.WeakSet()
+
+    def get(self, user_id: int):
+        with self._lock:
+            chats = self._users.get(user_id)
+            if chats is None:
+                return None
+            if self._expires[user_id] <= time.monotonic():
+                self._drop_user(user_id)
+                return None
+            self._users.move_to_end(user_id)
+            return self._view(chats)
+
+    def begin_fill(self, user_id: int) -> ChatListFill:
+        fill = ChatListFill(user_id)
+        with self._lock:
+            self._fills.add(fill)
+        return fill
+
+    def set(self, user_id: int, entries: list[dict], fill: ChatListFill):
+        with self._lock:
+            chats = {entry["chat_id"]: entry for entry in entries}
+            self._fills.discard(fill)
+            if fill.stale or not fill.chat_ids.isdisjoint(chats):
+                # served as loaded, the next request loads again
+                return self._view(chats)
+
+            self._drop_user(user_id)
+            self._users[user_id] = chats
+            self._expires[user_id] = time.monotonic() + self.ttl
+            for entry in entries:
+                self._chat_users.setdefault(entry["chat_id"], set()).add(user_id)
+
+            while len(self._users) > self.max_users:
+                oldest = next(iter(self._users))
+                self._drop_user(oldest)
+
+            return self._view(chats)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            self._touch_user(user_id)
+            self._drop_user(user_id)
+
+    def invalidate_chat(self, chat_id: int):
+        with self._lock:
+            self._touch_chat(chat_id)
+            for user_id in list(self._chat_users.get(chat_id, ())):
+                self._drop_user(user_id)
+
+    def clear(self):
+        with self._lock:
+            for fill in self._fills:
+                fill.stale = True
+            self._users.clear()
+            self._expires.clear()
+            self._chat_users.clear()
+
+    def add_chat(self, entry: dict, user_ids: list[int]):
+        with self._lock:
+            for user_id in user_ids:
+                self._touch_user(user_id)
+                chats = self._users.get(user_id)
+                if chats is not None:
+                    chats[entry["chat_id"]] = dict(entry)
+                    self._chat_users.setdefault(entry["chat_id"], set()).add(user_id)
+
+    def on_message_created(self, message: dict):
+        with self._lock:
+            self._touch_chat(message["chat_id"])
+            for user_id, entry in self._entries(message["chat_id"]):
+                entry["last_message"] = message
+                if message["sender_id"] == user_id:
+                    # sending reads the chat up to the new message
+                    entry["unread_count"] = 0
+                    entry["last_read_message_id"] = message["id"]
+                else:
+                    entry["unread_count"] += 1
+
+    def on_read(self, user_id: int, chat_id: int, message_id: int):
+        with self._lock:
+            self._touch_user(user_id)
+            chats = self._users.get(user_id)
+            entry = chats.get(chat_id) if chats else None
+            if entry is None or message_id <= entry["last_read_message_id"]:
+                return
+
+            entry["last_read_message_id"] = message_id
+            last = entry["last_message"]
+            if last is None or message_id >= last["id"]:
+                entry["unread_count"] = 0
+            else:
+                # read part way, only the database knows how many are left
+                self._drop_user(user_id)
+
+    def on_message_edited(self, chat_id: int, message_id: int, content: str):
+        with self._lock:
+            self._touch_chat(chat_id)
+            for _, entry in self._entries(chat_id):
+                last = entry["last_message"]
+                if last and last["id"] == message_id:
+                    entry["last_message"] = {**last, "content": content}
+
+    def on_message_deleted(self, chat_id: int, message_id: int, sender_id: int, previous_message: dict | None):
+        with self._lock:
+            self._touch_chat(chat_id)
+            for user_id, entry in self._entries(chat_id):
+                last = entry["last_message"]
+                if last and last["id"] == message_id:
+                    entry["last_message"] = previous_message
+
+                if sender_id != user_id and message_id > entry["last_read_message_id"] and entry["unread_count"] > 0:
+                    entry["unread_count"] -= 1
+
+    def listen(self, events):
+        events.on(MESSAGE_CREATED, self._on_remote_message)
+        events.on("edit_message", lambda chat_id, event: self.on_message_edited(chat_id, event["message_id"], event["new_content"]))
+        # the message before the deleted one isn't in the event, the lists showing it load again
+        events.on("delete_message", lambda chat_id, event: self.invalidate_chat(chat_id))
+        events.on("read", lambda chat_id, event: self.on_read(event["user_id"], chat_id, event["message_id"]))
+        events.on("chat_added", self._on_remote_chat_added)
+        # their name is gone from every list showing them
+        events.on("user_removed", lambda chat_id, event: self.clear())
+
+    def _on_remote_message(self, chat_id: int, event: dict):
+        # the event carries every field of the summary under the same names
+        self.on_message_created({key: event.get(key) for key in ("id", "chat_id", "sender_id", "content", "image_url", "sent_time")})
+
+    def _on_remote_chat_added(self, chat_id: int, event: dict):
+        for user_id in event["user_ids"]:
+            self.invalidate_user(user_id)
+
+    def _view(self, chats: dict[int, dict]):
+        entries = [dict(entry) for entry in chats.values()]
+        entries.sort(key=lambda e: (e["last_message"]["id"] if e["last_message"] else 0, e["chat_id"]), reverse=True)
+        return entries
+
+    def _entries(self, chat_id: int):
+        for user_id in self._chat_users.get(chat_id, ()):
+            chats = self._users.get(user_id)
+            if chats and chat_id in chats:
+                yield user_id, chats[chat_id]
+
+    def _touch_chat(self, chat_id: int):
+        for fill in self._fills:
+            fill.chat_ids.add(chat_id)
+
+    def _touch_user(self, user_id: int):
+        for fill in self._fills:
+            if fill.user_id == user_id:
+                fill.stale = True
+
+    def _drop_user(self, user_id: int):
+        self._expires.pop(user_id, None)
+        chats = self._users.pop(user_id, None)
+        if not chats:
+            return
+        for chat_id in chats:
+            users = self._chat_users.get(chat_id)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self._chat_users[chat_id]
+
+
+chat_list_cache = ChatListCache()
@@ -1,15 +1,64 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Text, DateTime
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Text, DateTime, Index, UniqueConstraint, CheckConstraint
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 
+from search import create_search_schema
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 500))
+# psycopg prepares a statement server-side after it has run this many times, 0 prepares immediately
+DB_PREPARE_THRESHOLD = int(os.getenv("DB_PREPARE_THRESHOLD", 5))
+
+
+def to_async_url(url: str) -> str:
+    for prefix in ("postgresql+psycopg2://", "postgresql+psycopg://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+psycopg://" + url[len(prefix):]
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://"):]
+    return url
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(DATABASE_URL)
+
+
+def engine_options(url: str) -> dict:
+    options = {"query_cache_size": DB_STATEMENT_CACHE_SIZE}
+    if url.startswith("sqlite"):
+        return options
+
+    options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+    if "+asyncpg" in url:
+        options["connect_args"] = {"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    elif "+psycopg" in url and "+psycopg2" not in url:
+        options["connect_args"] = {"prepare_threshold": DB_PREPARE_THRESHOLD}
+    return options
+
+
+# the sync engine is kept for init_db, alembic and offline scripts, request handlers use async_engine
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 
@@ -28,6 +77,8 @@ class Chat(Base):
     __tablename__ = "chats"
 
     id = Column(Integer, primary_key=True, index=True)
+    # highest seq handed out in chat_changes, bumped under the row lock so a chat's seqs commit in order
+    last_seq = Column(Integer, nullable=False, default=0, server_default="0")
     messages = relationship("Message", back_populates="chat", cascade="all, delete")
 
     participants = relationship("ChatParticipant", back_populates="chat", cascade="all, delete")
@@ -39,35 +90,81 @@ class ChatParticipant(Base):
     id = Column(Integer, primary_key=True)
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    # highest message id the user has read, written in batches by receipts.ReadReceiptBuffer
+    last_read_message_id = Column(Integer, nullable=False, default=0, server_default="0")
+    # messages past the pointer not sent by the user, kept in step by every write so the chat list reads it as is
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     chat = relationship("Chat", back_populates="participants")
     user = relationship("User", back_populates="chats")
 
+    __table_args__ = (
+        UniqueConstraint("user_id", "chat_id", name="uq_chat_participants_user_id_chat_id"),
+        Index("ix_chat_participants_chat_id", "chat_id"),
+    )
+
+
+class DirectChat(Base):
+    __tablename__ = "direct_chats"
+
+    # one row per pair of users, lower id first, so a DM lookup is a single primary key probe
+    user_low_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    user_high_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False, unique=True)
+
+    __table_args__ = (
+        CheckConstraint("user_low_id < user_high_id", name="ck_direct_chats_ordered_pair"),
+    )
+
 
 class Message(Base):
     __tablename__ = "messages"
 
     id = Column(Integer, primary_key=True)
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
-    sender_id = Column(Integer, nullable=False)
+    sender_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
     content = Column(Text, nullable=False)
     reply_content = Column(Text, nullable=True)
     sent_time = Column(DateTime, default=datetime.utcnow)
     image_url = Column(String, nullable=True)
+    image_hash = Column(String(64), nullable=True, index=True)
 
 
     chat = relationship("Chat", back_populates="messages")
 
+    __table_args__ = (
+        # sender_id rides along so unread counts are an index-only range scan past the read pointer
+        Index("ix_messages_chat_id_id", "chat_id", "id", postgresql_include=["sender_id"]),
+        Index("ix_messages_chat_id_sender_id_id", "chat_id", "sender_id", "id"),
+        # without it SQLite hands a deleted newest message's id to the next insert, sync and cursors rely on ids never coming back
+        {"sqlite_autoincrement": True},
+    )
+
+
+class ChatChange(Base):
+    __tablename__ = "chat_changes"
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
+    seq = Column(Integer, nullable=False)
+    # no foreign key, a delete keeps its row as the tombstone after the message is gone
+    message_id = Column(Integer, nullable=False)
+    kind = Column(String(16), nullable=False)
+    changed_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("chat_id", "seq", name="uq_chat_changes_chat_id_seq"),
+    )
+
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        create_search_schema(connection)
 
 
 if __name__ == "__main__":
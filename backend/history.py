@@ -0,0 +1,166 @@
+from sqlalchemy import insert, select
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import sys
+import zlib
+from datetime import datetime
+
+from database import AsyncSessionLocal, User, Chat, Message
+from changelog import record_changes, add_unread, CHANGE_CREATE
+
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 1000))
+
+EXPORT_COLUMNS = (
+    Message.id,
+    Message.sender_id,
+    User.username.label("sender_username"),
+    Message.content,
+    Message.reply_content,
+    Message.image_url,
+    Message.image_hash,
+    Message.sent_time,
+)
+
+
+def export_line(row) -> bytes:
+    data = row._asdict()
+    data["sent_time"] = data["sent_time"].isoformat() if data["sent_time"] else None
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+
+
+async def export_chat(chat_id: int):
+    # uses its own session so a StreamingResponse can keep reading after the request's session is gone
+    statement = (
+        select(*EXPORT_COLUMNS)
+        .outerjoin(User, User.id == Message.sender_id)
+        .where(Message.chat_id == chat_id)
+        .order_by(Message.id.asc())
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    async with AsyncSessionLocal() as db:
+        # server-side cursor, only one partition of rows is held at a time
+        result = await db.stream(statement)
+        async for rows in result.partitions():
+            yield b"".join(export_line(row) for row in rows)
+
+
+async def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def parse_line(line: bytes, chat_id: int) -> dict:
+    data = json.loads(line)
+    sent_time = data.get("sent_time")
+    return {
+        "chat_id": chat_id,
+        "sender_username": data.get("sender_username"),
+        "content": data.get("content") or "",
+        "reply_content": data.get("reply_content"),
+        "image_url": data.get("image_url"),
+        "image_hash": data.get("image_hash"),
+        "sent_time": datetime.fromisoformat(sent_time) if sent_time else datetime.utcnow(),
+    }
+
+
+async def import_batch(db, chat_id: int, batch: list[dict], sender_ids: dict):
+    # senders are matched by username, unknown ones come in as NULL like messages of deleted users
+    missing = {row["sender_username"] for row in batch if row["sender_username"] and row["sender_username"] not in sender_ids}
+    if missing:
+        found = dict((await db.execute(select(User.username, User.id).where(User.username.in_(missing)))).all())
+        sender_ids.update({username: found.get(username) for username in missing})
+
+    rows = []
+    for row in batch:
+        username = row.pop("sender_username")
+        rows.append({**row, "sender_id": sender_ids.get(username) if username else None})
+
+    result = await db.execute(insert(Message).returning(Message.id, sort_by_parameter_order=True), rows)
+    await record_changes(db, chat_id, [(message_id, CHANGE_CREATE) for message_id in result.scalars().all()])
+    await add_unread(db, chat_id, [row["sender_id"] for row in rows])
+    await db.commit()
+
+
+async def import_chat(chat_id: int, lines) -> int:
+    imported = 0
+    sender_ids = {}
+    batch = []
+    async with AsyncSessionLocal() as db:
+        if await db.get(Chat, chat_id) is None:
+            raise ValueError(f"Chat {chat_id} does not exist")
+
+        for line in lines:
+            if not line.strip():
+                continue
+            batch.append(parse_line(line, chat_id))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await import_batch(db, chat_id, batch, sender_ids)
+                imported += len(batch)
+                batch = []
+        if batch:
+            await import_batch(db, chat_id, batch, sender_ids)
+            imported += len(batch)
+    return imported
+
+
+def open_input(path: str):
+    if path == "-":
+        return sys.stdin.buffer
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    return gzip.open(path, "rb") if magic == b"\x1f\x8b" else open(path, "rb")
+
+
+async def export_to(chat_id: int, path: str, compress: bool):
+    chunks = export_chat(chat_id)
+    if compress:
+        chunks = gzip_chunks(chunks)
+
+    out = sys.stdout.buffer if path == "-" else open(path, "wb")
+    try:
+        async for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import a chat's history as NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("chat_id", type=int)
+    export_parser.add_argument("-o", "--output", default="-")
+    export_parser.add_argument("--gzip", action="store_true")
+
+    # imports write straight to the database, no live events go out for them: running servers show them
+    # once cached chat lists and hot windows expire (CHAT_LIST_CACHE_TTL, HOT_WINDOW_TTL), clients on /sync get them from the change log
+    import_parser = commands.add_parser("import")
+    import_parser.add_argument("chat_id", type=int)
+    import_parser.add_argument("input", nargs="?", default="-", help="NDJSON file, gzipped or not")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        asyncio.run(export_to(args.chat_id, args.output, args.gzip))
+    else:
+        with open_input(args.input) as lines:
+            try:
+                count = asyncio.run(import_chat(args.chat_id, lines))
+            except ValueError as e:
+                parser.exit(1, f"{e}\n")
+        print(f"Imported {count} messages into chat {args.chat_id}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+from sqlalchemy import insert
+
+import asyncio
+import logging
+import os
+
+from database import AsyncSessionLocal, Message
+from changelog import record_changes, add_unread, CHANGE_CREATE
+
+
+logger = logging.getLogger(__name__)
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 200))
+INGEST_MAX_DELAY = float(os.getenv("INGEST_MAX_DELAY_MS", 10)) / 1000
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 10000))
+WS_MESSAGE_MAX_LENGTH = int(os.getenv("WS_MESSAGE_MAX_LENGTH", 4000))
+
+
+class MessageWriter:
+    def __init__(self, batch_size: int = INGEST_BATCH_SIZE, max_delay: float = INGEST_MAX_DELAY, queue_size: int = INGEST_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue_size = queue_size
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+
+        # the sentinel lets the writer commit everything queued ahead of it before exiting
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, row: dict) -> asyncio.Future:
+        # waits only for queue space, the returned future resolves to (Message, seq) once committed
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((row, future))
+        return future
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                return
+
+            # give a burst up to max_delay to fill the batch, then take whatever is queued
+            if self._queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.max_delay)
+
+            batch = [item]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._commit(batch)
+
+    async def _commit(self, batch: list[tuple]):
+        try:
+            results = await self._insert([row for row, _ in batch])
+        except Exception:
+            logger.exception("Failed to commit a batch of %s messages, retrying one by one", len(batch))
+            # one bad row must not fail the messages of everyone else in the batch
+            for item in batch:
+                await self._commit_one(item)
+            return
+
+        for (row, future), (message_id, seq) in zip(batch, results):
+            if not future.done():
+                future.set_result((Message(id=message_id, **row), seq))
+
+    async def _commit_one(self, item: tuple):
+        row, future = item
+        try:
+            [(message_id, seq)] = await self._insert([row])
+        except Exception as e:
+            logger.exception("Failed to commit a message for chat %s", row["chat_id"])
+            if not future.done():
+                future.set_exception(e)
+                future.exception()
+            return
+
+        if not future.done():
+            future.set_result((Message(id=message_id, **row), seq))
+
+    async def _insert(self, rows: list[dict]) -> list[tuple]:
+        # (message_id, seq) per row, in row order
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                insert(Message).returning(Message.id, sort_by_parameter_order=True),
+                rows,
+            )
+            ids = result.scalars().all()
+
+            # one seq range per chat, chats locked in id order so concurrent writers can't deadlock
+            by_chat = {}
+            for position, (row, message_id) in enumerate(zip(rows, ids)):
+                by_chat.setdefault(row["chat_id"], []).append((position, message_id))
+            seqs = [None] * len(rows)
+            for chat_id in sorted(by_chat):
+                entries = by_chat[chat_id]
+                chat_seqs = await record_changes(db, chat_id, [(message_id, CHANGE_CREATE) for _, message_id in entries])
+                for (position, _), seq in zip(entries, chat_seqs):
+                    seqs[position] = seq
+                await add_unread(db, chat_id, [rows[position]["sender_id"] for position, _ in entries])
+
+            await db.commit()
+        return list(zip(ids, seqs))
+
+message_writer = MessageWriter()
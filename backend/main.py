@@ -1,16 +1,46 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
 from typing import Dict, List
 
-from routes import users, messages, chats
-from auth import get_current_user
+from routes import users, messages, chats, media, sync, presence
+from routes.messages import message_event, serialize_message
+from auth import get_current_user, authenticate_websocket
+from auth_cache import auth_cache
 from websocket import manager
-
-
-app = FastAPI()
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+from membership import membership
+from chat_cache import chat_list_cache, message_summary
+from message_cache import message_cache
+from remote_events import remote_events
+from ingest import message_writer, WS_MESSAGE_MAX_LENGTH
+from receipts import read_receipts, record_read
+from thumbnails import variant_generator
+from uploads import UploadLimitMiddleware
+from passwords import password_hasher
+from user_directory import user_search_cache
+from models import UserPublic, StatsResponse
+from database import async_engine
+from metrics import registry, MetricsMiddleware, instrument_engine, METRICS_TOKEN
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await manager.start()
+    message_writer.start()
+    read_receipts.start()
+    yield
+    await message_writer.stop()
+    await read_receipts.stop()
+    await manager.stop()
+    variant_generator.shutdown()
+    password_hasher.shutdown()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,8 +49,31 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(UploadLimitMiddleware)
+
+auth_cache.listen(remote_events)
+chat_list_cache.listen(remote_events)
+message_cache.listen(remote_events)
+manager.remote_listeners.append(remote_events)
+
+instrument_engine(async_engine.sync_engine)
+registry.callback("ws_connections", "Open websocket connections on this node", lambda: {
+    "chat": sum(len(c) for c in manager.active_connections.values()),
+    "user": sum(len(c) for c in manager.user_connections.values()),
+}, ("endpoint",))
+registry.callback("ws_users", "Users with at least one local /ws socket", lambda: len(manager.user_connections))
+registry.callback("ws_chats", "Chats routed to at least one local websocket", lambda: len(manager.active_connections.keys() | manager.chat_users.keys()))
+registry.callback("ingest_queue_depth", "Websocket messages waiting for the batch writer", lambda: message_writer._queue.qsize() if message_writer._queue else 0)
+registry.stats("auth_cache", "Token cache", auth_cache.stats)
+registry.stats("message_cache", "Hot window message cache", message_cache.stats)
+registry.stats("password_hasher", "Password hashing pool", password_hasher.stats)
+registry.stats("user_search_cache", "User directory page cache", user_search_cache.stats)
+registry.stats("presence", "Presence and typing state", manager.presence.stats)
+registry.stats("read_receipts", "Buffered read pointers", read_receipts.stats)
 
 active_connections: Dict[int, List[WebSocket]] = {}
+ack_tasks: set[asyncio.Task] = set()
 
 async def websocket_endpoint(websocket: WebSocket, chat_id: int):
     await websocket.accept()
@@ -37,20 +90,143 @@ async def websocket_endpoint(websocket: WebSocket, chat_id: int):
         active_connections[chat_id].remove(websocket)
 
 
+async def persist_and_ack(connection, chat_id: int, user, client_id, pending):
+    try:
+        message, seq = await pending
+    except Exception:
+        manager.send_to(connection, {"action": "error", "chat_id": chat_id, "client_id": client_id, "detail": "Message could not be saved"})
+        return
+
+    chat_list_cache.on_message_created(message_summary(message))
+    message_cache.on_message_created(serialize_message(message, user))
+    read_receipts.mark(user.id, chat_id, message.id)
+    manager.send_to(connection, {"action": "ack", "chat_id": chat_id, "client_id": client_id, "message_id": message.id, "seq": seq, "sent_time": message.sent_time.isoformat()})
+    await manager.broadcast(chat_id, message_event(message, user, seq))
+
+
+async def ingest_message(connection, chat_id: int, user, data: dict):
+    client_id = data.get("client_id")
+    content = data.get("content")
+    reply_content = data.get("reply_content")
+
+    if not isinstance(content, str) or not content.strip():
+        manager.send_to(connection, {"action": "error", "chat_id": chat_id, "client_id": client_id, "detail": "Message cannot be empty"})
+        return
+    # the quoted reply rides in every fanout frame too, so it gets the same bound
+    if len(content) > WS_MESSAGE_MAX_LENGTH or (reply_content is not None and (not isinstance(reply_content, str) or len(reply_content) > WS_MESSAGE_MAX_LENGTH)):
+        manager.send_to(connection, {"action": "error", "chat_id": chat_id, "client_id": client_id, "detail": "Invalid message"})
+        return
+    # Postgres text can't hold NUL, caught here rather than failing the batch the row is written in
+    if "\x00" in content or (reply_content and "\x00" in reply_content):
+        manager.send_to(connection, {"action": "error", "chat_id": chat_id, "client_id": client_id, "detail": "Invalid message"})
+        return
+
+    pending = await message_writer.submit({
+        "chat_id": chat_id,
+        "sender_id": user.id,
+        "content": content,
+        "reply_content": reply_content,
+        "image_url": None,
+        "sent_time": datetime.utcnow(),
+    })
+
+    # the receive loop moves on right away, acks go out in submit order as batches commit
+    task = asyncio.create_task(persist_and_ack(connection, chat_id, user, client_id, pending))
+    ack_tasks.add(task)
+    task.add_done_callback(ack_tasks.discard)
+
+
 @app.websocket("/ws/chat/{chat_id}")
-async def websocket_endpoint(websocket: WebSocket, chat_id: int):
-    await manager.connect(chat_id, websocket)
+async def websocket_endpoint(websocket: WebSocket, chat_id: int, token: str = Query(None)):
+    try:
+        user = await authenticate_websocket(token)
+        await membership.require_member(chat_id, user.id)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    connection = await manager.connect(chat_id, websocket, user.id)
     try:
         while True:
-            data = await websocket.receive_json()
+            data = await connection.receive()
+
+            action = data.get("action") if isinstance(data, dict) else None
+            if action == "send_message":
+                await ingest_message(connection, chat_id, user, data)
+            elif action == "typing":
+                await manager.typing(chat_id, user.id, data.get("typing") is not False)
+            elif action == "read" and isinstance(data.get("message_id"), int):
+                await record_read(user.id, chat_id, data["message_id"])
+            else:
+                manager.send_to(connection, {"action": "error", "chat_id": chat_id, "detail": "Unknown action"})
+    except:
+        manager.disconnect(connection)
+
 
-            await manager.broadcast(chat_id, data)
+# one socket per user for every chat they are in, frames name their chat with chat_id
+@app.websocket("/ws")
+async def user_websocket_endpoint(websocket: WebSocket, token: str = Query(None)):
+    try:
+        user = await authenticate_websocket(token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    chat_ids = await membership.chats_of(user.id)
+    connection = await manager.connect_user(user.id, websocket, chat_ids)
+    manager.send_to(connection, {"action": "ready", "chats": sorted(chat_ids)})
+    try:
+        while True:
+            data = await connection.receive()
+            if not isinstance(data, dict):
+                manager.send_to(connection, {"action": "error", "detail": "Invalid frame"})
+                continue
+
+            action = data.get("action")
+            chat_id = data.get("chat_id")
+            if not manager.routes(user.id, chat_id):
+                manager.send_to(connection, {"action": "error", "chat_id": chat_id, "client_id": data.get("client_id"), "detail": "Not a participant of this chat"})
+                continue
+
+            if action == "subscribe":
+                manager.subscribe(connection, chat_id)
+                manager.send_to(connection, {"action": "subscribed", "chat_id": chat_id})
+            elif action == "unsubscribe":
+                manager.unsubscribe(connection, chat_id)
+                manager.send_to(connection, {"action": "unsubscribed", "chat_id": chat_id})
+            elif action == "send_message":
+                await ingest_message(connection, chat_id, user, data)
+            elif action == "typing":
+                await manager.typing(chat_id, user.id, data.get("typing") is not False)
+            elif action == "read" and isinstance(data.get("message_id"), int):
+                await record_read(user.id, chat_id, data["message_id"])
+            else:
+                manager.send_to(connection, {"action": "error", "chat_id": chat_id, "detail": "Unknown action"})
     except:
-        manager.disconnect(chat_id, websocket)
+        manager.disconnect(connection)
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Missing or invalid token")
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats", response_model=StatsResponse)
+async def get_stats(current_user=Depends(get_current_user)):
+    return {
+        "message_cache": message_cache.stats(),
+        "auth_cache": auth_cache.stats(),
+        "passwords": password_hasher.stats(),
+        "user_search_cache": user_search_cache.stats(),
+        "presence": manager.presence.stats(),
+        "read_receipts": read_receipts.stats(),
+    }
 
 
-@app.get("/me")
-def get_me(current_user=Depends(get_current_user)):
+@app.get("/me", response_model=UserPublic)
+async def get_me(current_user=Depends(get_current_user)):
     return {
         "id": current_user.id,
         "username": current_user.username,
@@ -61,3 +237,6 @@ def get_me(current_user=Depends(get_current_user)):
 app.include_router(users.router)
 app.include_router(messages.router)
 app.include_router(chats.router)
+app.include_router(media.router)
+app.include_router(sync.router)
+app.include_router(presence.router)
@@ -0,0 +1,166 @@
+from fastapi import HTTPException
+from sqlalchemy import select
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from database import AsyncSessionLocal, ChatParticipant
+
+
+MEMBERSHIP_CACHE_CHATS = int(os.getenv("MEMBERSHIP_CACHE_CHATS", 50000))
+MEMBERSHIP_CACHE_USERS = int(os.getenv("MEMBERSHIP_CACHE_USERS", 50000))
+# bounds how long another worker's create_chat can go unseen here
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", 300))
+
+
+class _ExpiringLRU:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict[int, tuple[set, float]] = OrderedDict()
+
+    def get(self, key: int):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        if item[1] <= time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return item[0]
+
+    def set(self, key: int, value: set):
+        self._items[key] = (value, time.monotonic() + self.ttl)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def pop(self, key: int):
+        item = self._items.pop(key, None)
+        return item[0] if item else None
+
+    def values(self):
+        return [value for value, _ in self._items.values()]
+
+    def clear(self):
+        self._items.clear()
+
+
+class MembershipIndex:
+    def __init__(self, max_chats: int = MEMBERSHIP_CACHE_CHATS, max_users: int = MEMBERSHIP_CACHE_USERS, ttl: float = MEMBERSHIP_CACHE_TTL):
+        # chat_id -> user_ids and user_id -> chat_ids, each loaded on first use
+        self._chat_members = _ExpiringLRU(max_chats, ttl)
+        self._user_chats = _ExpiringLRU(max_users, ttl)
+        self._loading: dict[tuple, asyncio.Future] = {}
+        # bumped by every write, a load that ran across one may have missed it and isn't cached
+        self._generation = 0
+
+    async def members(self, chat_id: int) -> set[int]:
+        members = self._chat_members.get(chat_id)
+        if members is None:
+            # unknown chats are not cached, another worker may create them any moment
+            members = await self._load(
+                self._chat_members,
+                ("chat", chat_id),
+                select(ChatParticipant.user_id).where(ChatParticipant.chat_id == chat_id),
+                cache_empty=False,
+            )
+        return members
+
+    async def members_of_chats(self, chat_ids) -> dict[int, set[int]]:
+        # the cached chats plus one query for all the others, not one per chat
+        members = {}
+        missing = []
+        for chat_id in chat_ids:
+            cached = self._chat_members.get(chat_id)
+            if cached is None:
+                missing.append(chat_id)
+            else:
+                members[chat_id] = set(cached)
+
+        if missing:
+            generation = self._generation
+            async with AsyncSessionLocal() as db:
+                rows = (await db.execute(
+                    select(ChatParticipant.chat_id, ChatParticipant.user_id).where(ChatParticipant.chat_id.in_(missing))
+                )).all()
+            loaded = {chat_id: set() for chat_id in missing}
+            for chat_id, user_id in rows:
+                loaded[chat_id].add(user_id)
+            for chat_id, user_ids in loaded.items():
+                if user_ids and generation == self._generation:
+                    self._chat_members.set(chat_id, set(user_ids))
+            members.update(loaded)
+        return members
+
+    async def chats_of(self, user_id: int) -> set[int]:
+        chats = self._user_chats.get(user_id)
+        if chats is None:
+            chats = await self._load(
+                self._user_chats,
+                ("user", user_id),
+                select(ChatParticipant.chat_id).where(ChatParticipant.user_id == user_id),
+            )
+        return chats
+
+    async def is_member(self, chat_id: int, user_id: int) -> bool:
+        return user_id in await self.members(chat_id)
+
+    async def require_member(self, chat_id: int, user_id: int):
+        members = await self.members(chat_id)
+        if not members:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        if user_id not in members:
+            raise HTTPException(status_code=403, detail="User not a participant of the chat")
+
+    def add_chat(self, chat_id: int, user_ids):
+        self._generation += 1
+        self._chat_members.set(chat_id, set(user_ids))
+        for user_id in user_ids:
+            chats = self._user_chats.get(user_id)
+            if chats is not None:
+                chats.add(chat_id)
+
+    def remove_user(self, user_id: int):
+        self._generation += 1
+        self._user_chats.pop(user_id)
+        for members in self._chat_members.values():
+            members.discard(user_id)
+
+    def clear(self):
+        self._generation += 1
+        self._chat_members.clear()
+        self._user_chats.clear()
+
+    async def _load(self, cache: _ExpiringLRU, key: tuple, query, cache_empty: bool = True) -> set[int]:
+        # concurrent misses for the same key share one query
+        pending = self._loading.get(key)
+        if pending is not None:
+            return set(await asyncio.shield(pending))
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        generation = self._generation
+        try:
+            async with AsyncSessionLocal() as db:
+                result = set((await db.scalars(query)).all())
+            # an add_chat or remove_user landing during the query would be overwritten, the next lookup loads again
+            if generation == self._generation and (result or cache_empty):
+                cache.set(key[1], set(result))
+            future.set_result(result)
+            return set(result)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # nobody may be waiting on it, don't let asyncio warn about an unretrieved exception
+            future.exception()
+            raise
+        finally:
+            del self._loading[key]
+
+
+membership = MembershipIndex()
@@ -0,0 +1,211 @@
+from collections import OrderedDict, deque
+from datetime import datetime
+import os
+import threading
+import time
+
+from remote_events import MESSAGE_CREATED
+
+
+HOT_WINDOW_SIZE = int(os.getenv("HOT_WINDOW_SIZE", 100))
+HOT_WINDOW_MEMORY = int(os.getenv("HOT_WINDOW_MEMORY_MB", 64)) * 1024 * 1024
+# windows of chats nobody here has open get no events from other workers, they are served for at most this long
+HOT_WINDOW_TTL = float(os.getenv("HOT_WINDOW_TTL", 10))
+# rough per-message cost of the dict, its keys and the sender dict on top of the text itself
+MESSAGE_OVERHEAD = 600
+
+
+def message_size(message: dict) -> int:
+    return MESSAGE_OVERHEAD + sum(
+        len(message[key]) for key in ("content", "reply_content", "image_url") if message.get(key)
+    )
+
+
+def event_message(event: dict) -> dict:
+    # a broadcast new-message event in the shape history pages use
+    return {
+        "id": event["id"],
+        "chat_id": event["chat_id"],
+        "content": event["content"],
+        "reply_content": event.get("reply_content"),
+        "sent_time": datetime.fromisoformat(event["sent_time"]),
+        "image_url": event.get("image_url"),
+        "image_hash": event.get("image_hash"),
+        "thumbnail_url": event.get("thumbnail_url"),
+        "preview_url": event.get("preview_url"),
+        "sender": {
+            "id": event["sender_id"],
+            "username": event["sender_username"],
+            "display_name": event["sender_display_name"],
+        },
+    }
+
+
+class HotWindow:
+    def __init__(self, messages: list[dict], complete: bool, expires_at: float):
+        self.messages = deque(messages)
+        # True when the window holds every message of the chat, so a short window is still a full answer
+        self.complete = complete
+        self.expires_at = expires_at
+        self.size = sum(message_size(m) for m in messages)
+
+
+class MessageWindowCache:
+    def __init__(self, window_size: int = HOT_WINDOW_SIZE, max_memory: int = HOT_WINDOW_MEMORY, ttl: float = HOT_WINDOW_TTL):
+        self.window_size = window_size
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # chat_id -> HotWindow, least recently used first
+        self._chats: OrderedDict[int, HotWindow] = OrderedDict()
+        # chat_id -> token of the fill in flight, a write to the chat revokes it
+        self._fills: dict[int, object] = {}
+
+    def latest(self, chat_id: int, limit: int):
+        # newest `limit` messages oldest first plus has_more, or None when the window can't answer
+        with self._lock:
+            window = self._chats.get(chat_id)
+            if window is not None and window.expires_at <= time.monotonic():
+                self._drop(chat_id)
+                window = None
+            if window is None or (len(window.messages) < limit and not window.complete):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._chats.move_to_end(chat_id)
+            messages = list(window.messages)
+            return messages[-limit:], len(messages) > limit or not window.complete
+
+    def begin_fill(self, chat_id: int):
+        token = object()
+        with self._lock:
+            self._fills[chat_id] = token
+        return token
+
+    def fill(self, chat_id: int, token, messages: list[dict], complete: bool):
+        with self._lock:
+            # a message written while the page was loading may be missing from it
+            if self._fills.get(chat_id) is not token:
+                return
+            del self._fills[chat_id]
+
+            self._drop(chat_id)
+            window = HotWindow(messages[-self.window_size:], complete and len(messages) <= self.window_size, time.monotonic() + self.ttl)
+            self._chats[chat_id] = window
+            self.memory += window.size
+            self._evict()
+
+    def on_message_created(self, message: dict):
+        with self._lock:
+            self._fills.pop(message["chat_id"], None)
+            window = self._chats.get(message["chat_id"])
+            if window is None:
+                return
+
+            self._chats.move_to_end(message["chat_id"])
+            messages = window.messages
+            if not messages or message["id"] > messages[-1]["id"]:
+                messages.append(message)
+            elif any(m["id"] == message["id"] for m in messages):
+                return
+            elif message["id"] < messages[0]["id"] and not window.complete:
+                return
+            else:
+                # batched websocket sends can be announced slightly out of id order
+                position = next(i for i, m in enumerate(messages) if m["id"] > message["id"])
+                messages.insert(position, message)
+
+            window.size += message_size(message)
+            self.memory += message_size(message)
+            if len(messages) > self.window_size:
+                dropped = messages.popleft()
+                window.size -= message_size(dropped)
+                self.memory -= message_size(dropped)
+                window.complete = False
+            self._evict()
+
+    def on_message_edited(self, chat_id: int, message_id: int, content: str):
+        with self._lock:
+            self._fills.pop(chat_id, None)
+            window = self._chats.get(chat_id)
+            if window is None:
+                return
+
+            for i, message in enumerate(window.messages):
+                if message["id"] == message_id:
+                    # replaced rather than mutated, pages already handed out keep their copy
+                    edited = {**message, "content": content}
+                    window.messages[i] = edited
+                    window.size += message_size(edited) - message_size(message)
+                    self.memory += message_size(edited) - message_size(message)
+                    break
+
+    def on_message_deleted(self, chat_id: int, message_id: int):
+        with self._lock:
+            self._fills.pop(chat_id, None)
+            window = self._chats.get(chat_id)
+            if window is None:
+                return
+
+            for message in window.messages:
+                if message["id"] == message_id:
+                    window.messages.remove(message)
+                    window.size -= message_size(message)
+                    self.memory -= message_size(message)
+                    break
+
+    def invalidate_chat(self, chat_id: int):
+        with self._lock:
+            self._fills.pop(chat_id, None)
+            self._drop(chat_id)
+
+    def listen(self, events):
+        events.on(MESSAGE_CREATED, self._on_remote_message)
+        events.on("edit_message", lambda chat_id, event: self.on_message_edited(chat_id, event["message_id"], event["new_content"]))
+        events.on("delete_message", lambda chat_id, event: self.on_message_deleted(chat_id, event["message_id"]))
+        # windows still carry the removed user as sender
+        events.on("user_removed", lambda chat_id, event: self.clear())
+
+    def _on_remote_message(self, chat_id: int, event: dict):
+        if "sender_display_name" in event:
+            self.on_message_created(event_message(event))
+        else:
+            # from a node that predates the field, the window loads again
+            self.invalidate_chat(chat_id)
+
+    def clear(self):
+        with self._lock:
+            self._chats.clear()
+            self._fills.clear()
+            self.memory = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "chats": len(self._chats),
+                "memory_bytes": self.memory,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def _evict(self):
+        while self.memory > self.max_memory and self._chats:
+            oldest = next(iter(self._chats))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, chat_id: int):
+        window = self._chats.pop(chat_id, None)
+        if window is not None:
+            self.memory -= window.size
+
+
+message_cache = MessageWindowCache()
@@ -0,0 +1,241 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+import logging
+import math
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# a statement repeated this many times in one request is reported as a likely N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", 10))
+# set to require `Authorization: Bearer <token>` on /metrics
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def format_value(value) -> str:
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, self.label_names, labels, value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+
+class CallbackGauge:
+    # read when /metrics is scraped, so the hot paths don't pay for it
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, callback, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.callback = callback
+
+    def samples(self):
+        value = self.callback()
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for labels, sample in items:
+            yield self.name, self.label_names, labels if isinstance(labels, tuple) else (labels,), sample
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum, count]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        bucket_names = self.label_names + ("le",)
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", bucket_names, labels + (format_value(float(bound)),), cumulative
+            yield f"{self.name}_sum", self.label_names, labels, total
+            yield f"{self.name}_count", self.label_names, labels, count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name: str, help: str, callback, labels: tuple = ()):
+        return self.register(CallbackGauge(name, help, callback, labels))
+
+    def stats(self, prefix: str, help: str, stats):
+        # one gauge per numeric key of an existing stats() dict
+        for key, value in stats().items():
+            if isinstance(value, (int, float)):
+                self.callback(f"{prefix}_{key}", f"{help}: {key}", lambda key=key: stats()[key])
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            try:
+                for name, label_names, labels, value in metric.samples():
+                    lines.append(f"{name}{format_labels(label_names, labels)} {format_value(value)}")
+            except Exception:
+                logger.exception("Collecting metric %s failed", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter("http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+http_duration = registry.histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+http_in_flight = registry.gauge("http_requests_in_flight", "HTTP requests being served")
+
+db_queries = registry.counter("db_queries_total", "SQL statements executed", ("context",))
+db_query_duration = registry.histogram("db_query_duration_seconds", "SQL statement latency", ("context",))
+db_queries_per_request = registry.histogram("db_queries_per_request", "SQL statements per HTTP request", ("method", "route"), COUNT_BUCKETS)
+db_n_plus_one = registry.counter("db_n_plus_one_total", f"Requests repeating one statement {N_PLUS_ONE_THRESHOLD}+ times", ("method", "route"))
+
+ws_connections_opened = registry.counter("ws_connections_opened_total", "Websocket connections accepted")
+ws_broadcast_duration = registry.histogram("ws_broadcast_duration_seconds", "Time to encode-once and enqueue a broadcast for local sockets")
+ws_fanout_recipients = registry.histogram("ws_fanout_recipients", "Local sockets reached per broadcast", (), COUNT_BUCKETS)
+ws_delivery_lag = registry.histogram("ws_delivery_lag_seconds", "Time from broadcast to the frame being written to a socket")
+ws_dropped = registry.counter("ws_dropped_messages_total", "Frames dropped from full socket queues")
+ws_slow_disconnects = registry.counter("ws_slow_consumer_disconnects_total", "Sockets closed for falling behind")
+
+
+class RequestStats:
+    __slots__ = ("route", "queries", "statements")
+
+    def __init__(self):
+        self.route = "unmatched"
+        self.queries = 0
+        self.statements: dict[str, int] = {}
+
+
+current_request: ContextVar[RequestStats | None] = ContextVar("current_request", default=None)
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.inc(amount=-1)
+            current_request.reset(token)
+
+            # the route template, not the raw path, so ids don't explode the label set
+            route = scope.get("route")
+            stats.route = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            http_requests.inc(method, stats.route, status)
+            http_duration.observe(elapsed, method, stats.route)
+            db_queries_per_request.observe(stats.queries, method, stats.route)
+
+            if stats.statements:
+                statement, repeats = max(stats.statements.items(), key=lambda item: item[1])
+                if repeats >= N_PLUS_ONE_THRESHOLD:
+                    db_n_plus_one.inc(method, stats.route)
+                    logger.warning("%s %s ran one statement %s times, likely N+1: %s", method, stats.route, repeats, statement[:200])
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    stats = current_request.get()
+    # statements outside a request come from the ingest writer, membership loads and other background work
+    context = "background" if stats is None else "request"
+    db_queries.inc(context)
+    db_query_duration.observe(time.perf_counter() - started, context)
+
+    if stats is not None:
+        stats.queries += 1
+        stats.statements[statement] = stats.statements.get(statement, 0) + 1
+
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
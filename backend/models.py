@@ -1,5 +1,7 @@
 from pydantic import BaseModel
 
+from datetime import datetime
+
 
 class UserCreate(BaseModel):
     username: str
@@ -21,5 +23,168 @@ class MessageSend(BaseModel):
 class MessageEdit(BaseModel):
     new_content: str
 
+class ReadRequest(BaseModel):
+    message_id: int
+
 class CurrentChat(BaseModel):
     chat_id: str
+
+
+class UserBrief(BaseModel):
+    id: int
+    username: str
+
+class UserPublic(UserBrief):
+    display_name: str | None = None
+
+class RegisterResponse(BaseModel):
+    message: str
+    user: UserBrief
+
+class TokenResponse(BaseModel):
+    access_token: str
+    token_type: str
+
+class UserList(BaseModel):
+    users: list[UserPublic]
+    next_cursor: str | None = None
+
+class DeleteUserResponse(BaseModel):
+    message: str
+    deleted_user: list[str]
+
+class CreateChatResponse(BaseModel):
+    chat_id: int
+    message: str | None = None
+    participants: list[UserBrief] | None = None
+
+class MessageSummary(BaseModel):
+    id: int
+    chat_id: int
+    sender_id: int | None
+    content: str
+    image_url: str | None
+    sent_time: str | None
+
+class ChatListEntry(BaseModel):
+    chat_id: int
+    participants: list[UserPublic]
+    last_message: MessageSummary | None
+    unread_count: int
+    last_read_message_id: int
+
+class ChatList(BaseModel):
+    chats: list[ChatListEntry]
+
+class MessageOut(BaseModel):
+    id: int
+    chat_id: int
+    content: str
+    reply_content: str | None
+    sent_time: datetime | None
+    image_url: str | None
+    image_hash: str | None
+    thumbnail_url: str | None
+    preview_url: str | None
+    sender: UserPublic | None
+
+class MessageCursors(BaseModel):
+    before: str | None
+    after: str | None
+
+class MessagesPage(BaseModel):
+    messages: list[MessageOut]
+    has_more: bool
+    cursors: MessageCursors
+
+class MessageEvent(BaseModel):
+    id: int
+    seq: int | None
+    chat_id: int
+    sender_id: int | None
+    content: str
+    reply_content: str | None
+    image_url: str | None
+    image_hash: str | None
+    thumbnail_url: str | None
+    preview_url: str | None
+    sent_time: str
+    sender_username: str
+    sender_display_name: str | None
+
+class SendMessageResponse(BaseModel):
+    message: str
+    message_details: MessageEvent
+
+class SearchResult(BaseModel):
+    id: int
+    chat_id: int
+    sent_time: datetime | None
+    rank: float
+    snippet: str
+    sender: UserPublic | None
+
+class SearchPage(BaseModel):
+    results: list[SearchResult]
+    next_cursor: str | None
+
+class DeletedMessage(BaseModel):
+    message_id: int
+    content: str
+
+class DeleteMessageResponse(BaseModel):
+    message: str
+    deleted_message: DeletedMessage
+
+class EditedMessage(BaseModel):
+    message_id: int
+    content: str
+
+class EditMessageResponse(BaseModel):
+    message: str
+    edit_message: EditedMessage
+
+class SyncChange(BaseModel):
+    seq: int
+    kind: str
+    message_id: int
+    message: MessageOut | None
+
+class SyncPage(BaseModel):
+    chat_id: int
+    changes: list[SyncChange]
+    since: int
+    has_more: bool
+
+class UserPresence(BaseModel):
+    user_id: int
+    online: bool
+    last_seen: datetime | None = None
+
+class ChatTyping(BaseModel):
+    chat_id: int
+    user_ids: list[int]
+
+class PresencePage(BaseModel):
+    users: list[UserPresence]
+    typing: list[ChatTyping]
+
+class ReadResponse(BaseModel):
+    chat_id: int
+    last_read_message_id: int
+
+class ReadReceipt(BaseModel):
+    user_id: int
+    last_read_message_id: int
+
+class ReceiptList(BaseModel):
+    chat_id: int
+    receipts: list[ReadReceipt]
+
+class StatsResponse(BaseModel):
+    message_cache: dict[str, int | float]
+    auth_cache: dict[str, int | float]
+    passwords: dict[str, int | float]
+    user_search_cache: dict[str, int | float]
+    presence: dict[str, int | float]
+    read_receipts: dict[str, int | float]
@@ -0,0 +1,99 @@
+from fastapi import HTTPException
+
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", 2))
+# hashes allowed to wait for a worker, anything beyond is shed with 503
+PASSWORD_MAX_QUEUE = int(os.getenv("PASSWORD_MAX_QUEUE", 32))
+PASSWORD_RETRY_AFTER = int(os.getenv("PASSWORD_RETRY_AFTER", 2))
+
+
+def _hash_password(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check_password(password: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed)
+
+
+def hash_rounds(hashed: str):
+    # bcrypt hashes look like $2b$12$<salt+hash>
+    try:
+        return int(hashed.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    def __init__(self, workers: int = PASSWORD_WORKERS, max_queue: int = PASSWORD_MAX_QUEUE, rounds: int = BCRYPT_ROUNDS):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.rounds = rounds
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.seconds_total = 0.0
+        self.seconds_max = 0.0
+        self._executor: ProcessPoolExecutor | None = None
+
+    async def hash(self, password: str) -> str:
+        hashed = await self._run(_hash_password, password.encode(), self.rounds)
+        return hashed.decode()
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(_check_password, password.encode(), hashed.encode())
+
+    def needs_rehash(self, hashed: str) -> bool:
+        return hash_rounds(hashed) != self.rounds
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "seconds_total": self.seconds_total,
+            "seconds_max": self.seconds_max,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, fn, *args):
+        if self.in_flight >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Too many login attempts in progress, try again shortly",
+                headers={"Retry-After": str(PASSWORD_RETRY_AFTER)},
+            )
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.in_flight -= 1
+            self.completed += 1
+            self.seconds_total += elapsed
+            self.seconds_max = max(self.seconds_max, elapsed)
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from membership import membership
+
+
+logger = logging.getLogger(__name__)
+
+# users of a node that stops refreshing them (crashed, partitioned) go offline after this long
+PRESENCE_TTL = float(os.getenv("PRESENCE_TTL", 60))
+# a reconnect within this long (page reload, flaky network) doesn't flap the user offline and back
+PRESENCE_OFFLINE_GRACE = float(os.getenv("PRESENCE_OFFLINE_GRACE", 5))
+# at most one typing event per user per chat this often, keystrokes in between are absorbed
+TYPING_INTERVAL = float(os.getenv("TYPING_INTERVAL", 3))
+# a typing indicator nobody renewed is cleared after this long
+TYPING_TIMEOUT = float(os.getenv("TYPING_TIMEOUT", 6))
+# offline users whose last seen time is kept, the longest gone are forgotten first
+PRESENCE_LAST_SEEN_MAX = int(os.getenv("PRESENCE_LAST_SEEN_MAX", 100000))
+
+PRESENCE_SWEEP_INTERVAL = 1
+# user ids per refresh event, keeps each one well under the NOTIFY payload limit
+PRESENCE_REFRESH_CHUNK = 500
+
+
+def format_time(at: float | None):
+    return datetime.utcfromtimestamp(at).isoformat() if at is not None else None
+
+
+class PresenceTracker:
+    # online and typing state, kept in memory only and shared between nodes over the broker
+    def __init__(self, manager, ttl: float = PRESENCE_TTL, offline_grace: float = PRESENCE_OFFLINE_GRACE,
+                 typing_interval: float = TYPING_INTERVAL, typing_timeout: float = TYPING_TIMEOUT,
+                 last_seen_max: int = PRESENCE_LAST_SEEN_MAX):
+        self.manager = manager
+        self.ttl = ttl
+        self.offline_grace = offline_grace
+        self.typing_interval = typing_interval
+        self.typing_timeout = typing_timeout
+        self.last_seen_max = last_seen_max
+        # user_id -> open sockets on this node
+        self.local: dict[int, int] = {}
+        # user_id -> when their grace period ends, their last local socket is gone
+        self.pending_offline: dict[int, float] = {}
+        # user_id -> wall clock expiry, for users connected to other nodes
+        self.remote: dict[int, float] = {}
+        # user_id -> wall clock time they went offline, longest gone first
+        self.last_seen: OrderedDict[int, float] = OrderedDict()
+        # chat_id -> user_id -> when their typing indicator expires
+        self.typing: dict[int, dict[int, float]] = {}
+        # (chat_id, user_id) -> when their last typing event went out
+        self.typing_sent: dict[tuple[int, int], float] = {}
+        self.rate_limited = 0
+        self._task: asyncio.Task | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._sweep())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.local or user_id in self.pending_offline or self.remote.get(user_id, 0) > time.time()
+
+    def socket_opened(self, user_id: int):
+        self.last_seen.pop(user_id, None)
+        self.local[user_id] = self.local.get(user_id, 0) + 1
+        if self.local[user_id] == 1 and self.pending_offline.pop(user_id, None) is None:
+            self._announce(user_id, True)
+
+    def socket_closed(self, user_id: int):
+        count = self.local.get(user_id, 0) - 1
+        if count > 0:
+            self.local[user_id] = count
+            return
+        self.local.pop(user_id, None)
+        self.pending_offline[user_id] = time.monotonic() + self.offline_grace
+
+    def typing_event(self, chat_id: int, user_id: int, typing: bool = True):
+        # the event to broadcast, or None when it would add nothing
+        key = (chat_id, user_id)
+        now = time.monotonic()
+        if typing:
+            # an indicator that already expired is renewed right away
+            if now - self.typing_sent.get(key, -math.inf) < self.typing_interval and user_id in self.typing.get(chat_id, ()):
+                self.rate_limited += 1
+                return None
+            self.typing_sent[key] = now
+        else:
+            if user_id not in self.typing.get(chat_id, ()):
+                return None
+            self.typing_sent.pop(key, None)
+
+        return {"action": "typing", "chat_id": chat_id, "user_id": user_id, "typing": typing, "timeout": self.typing_timeout}
+
+    def observe(self, chat_id: int, message):
+        # sees every event delivered on this node, local or from other nodes
+        if not isinstance(message, dict):
+            return
+
+        if message.get("action") == "typing":
+            user_id = message.get("user_id")
+            if message.get("typing"):
+                self.typing.setdefault(chat_id, {})[user_id] = time.monotonic() + self.typing_timeout
+            else:
+                self._clear_typing(chat_id, user_id)
+        elif "action" not in message and message.get("sender_id") is not None:
+            # a sent message ends the sender's typing, clients drop the indicator on it too
+            self._clear_typing(chat_id, message["sender_id"])
+            self.typing_sent.pop((chat_id, message["sender_id"]), None)
+
+    def on_control(self, message: dict):
+        at = message["at"]
+        for user_id in message["user_ids"]:
+            if message["online"]:
+                was_online = self.is_online(user_id)
+                self.remote[user_id] = at + self.ttl
+                self.last_seen.pop(user_id, None)
+                if not was_online:
+                    self._spawn(self._notify(user_id, True, at))
+            elif user_id in self.local or user_id in self.pending_offline:
+                # still connected here, tell the other nodes again
+                self._spawn(self._publish([user_id], True))
+            elif self.remote.pop(user_id, None) is not None:
+                self._went_offline(user_id, at)
+                self._spawn(self._notify(user_id, False, at))
+
+    def snapshot(self, user_ids, chat_ids) -> dict:
+        now = time.monotonic()
+        return {
+            "users": [
+                {
+                    "user_id": user_id,
+                    "online": self.is_online(user_id),
+                    "last_seen": None if self.is_online(user_id) else format_time(self.last_seen.get(user_id)),
+                }
+                for user_id in user_ids
+            ],
+            "typing": [
+                {"chat_id": chat_id, "user_ids": sorted(u for u, expires_at in self.typing[chat_id].items() if expires_at > now)}
+                for chat_id in chat_ids if chat_id in self.typing
+            ],
+        }
+
+    def stats(self):
+        return {
+            "local_users": len(self.local),
+            "remote_users": len(self.remote),
+            "typing_chats": len(self.typing),
+            "last_seen": len(self.last_seen),
+            "typing_rate_limited": self.rate_limited,
+        }
+
+    def _clear_typing(self, chat_id: int, user_id: int):
+        users = self.typing.get(chat_id)
+        if users is not None and users.pop(user_id, None) is not None and not users:
+            del self.typing[chat_id]
+
+    def _went_offline(self, user_id: int, at: float):
+        self.last_seen[user_id] = at
+        self.last_seen.move_to_end(user_id)
+        while len(self.last_seen) > self.last_seen_max:
+            self.last_seen.popitem(last=False)
+
+    def _announce(self, user_id: int, online: bool):
+        at = time.time()
+        if not online:
+            self._went_offline(user_id, at)
+        self._spawn(self._publish([user_id], online, at))
+        self._spawn(self._notify(user_id, online, at))
+
+    async def _publish(self, user_ids: list[int], online: bool, at: float | None = None):
+        await self.manager.publish_control({"action": "presence", "user_ids": user_ids, "online": online, "at": at or time.time()})
+
+    async def _notify(self, user_id: int, online: bool, at: float):
+        # one frame per local socket that shares a chat with the user, however many chats they share
+        chat_ids = await membership.chats_of(user_id)
+        event = {"action": "presence", "user_id": user_id, "online": online, "last_seen": None if online else format_time(at)}
+        self.manager.send_to_chats(chat_ids, event, coalesce_key=("presence", user_id), skip_user=user_id)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _sweep(self):
+        next_refresh = time.monotonic() + self.ttl / 3
+        while True:
+            await asyncio.sleep(PRESENCE_SWEEP_INTERVAL)
+            try:
+                self._expire()
+                if time.monotonic() >= next_refresh:
+                    next_refresh = time.monotonic() + self.ttl / 3
+                    # lets other nodes tell a quiet user from one whose node went away
+                    user_ids = list(self.local) + list(self.pending_offline)
+                    for i in range(0, len(user_ids), PRESENCE_REFRESH_CHUNK):
+                        await self._publish(user_ids[i:i + PRESENCE_REFRESH_CHUNK], True)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Presence sweep failed")
+
+    def _expire(self):
+        now, wall = time.monotonic(), time.time()
+
+        for user_id, until in list(self.pending_offline.items()):
+            if until <= now:
+                del self.pending_offline[user_id]
+                self._announce(user_id, False)
+
+        for user_id, expires_at in list(self.remote.items()):
+            if expires_at <= wall:
+                del self.remote[user_id]
+                if not self.is_online(user_id):
+                    self._went_offline(user_id, expires_at - self.ttl)
+                    self._spawn(self._notify(user_id, False, expires_at - self.ttl))
+
+        for chat_id, users in list(self.typing.items()):
+            for user_id, expires_at in list(users.items()):
+                if expires_at <= now:
+                    # every node clears its own sockets, nothing goes over the broker
+                    self.manager.deliver(chat_id, {"action": "typing", "chat_id": chat_id, "user_id": user_id, "typing": False, "timeout": self.typing_timeout}, ("typing", chat_id, user_id), True, user_id)
+
+        for key, sent_at in list(self.typing_sent.items()):
+            if now - sent_at >= self.typing_interval:
+                del self.typing_sent[key]
@@ -0,0 +1,188 @@
+from sqlalchemy import Integer, and_, bindparam, case, func, select, update
+
+from collections import OrderedDict
+import asyncio
+import logging
+import os
+
+from database import AsyncSessionLocal, ChatParticipant, Message
+from chat_cache import chat_list_cache
+from websocket import manager
+
+
+logger = logging.getLogger(__name__)
+
+READ_FLUSH_INTERVAL = float(os.getenv("READ_FLUSH_INTERVAL", 2))
+# (user, chat) pointers remembered after a flush, so re-reading an old message broadcasts nothing
+READ_KNOWN_POINTERS = int(os.getenv("READ_KNOWN_POINTERS", 100000))
+
+participants = ChatParticipant.__table__
+
+# pointers only move forward, and never past the chat's last message,
+# so flushes from several nodes can land in any order
+new_pointer = bindparam("m", type_=Integer)
+last_message_id = select(func.max(Message.id)).where(Message.chat_id == bindparam("c")).scalar_subquery()
+# the counter only loses the messages between the old and new pointer, reading up to the end clears it
+just_read = (
+    select(func.count(Message.id))
+    .where(
+        Message.chat_id == bindparam("c"),
+        Message.id > participants.c.last_read_message_id,
+        Message.id <= new_pointer,
+        Message.sender_id.is_distinct_from(bindparam("u")),
+    )
+    .scalar_subquery()
+)
+still_unread = participants.c.unread_count - just_read
+ADVANCE_READ_POINTER = (
+    update(participants)
+    .where(
+        participants.c.user_id == bindparam("u"),
+        participants.c.chat_id == bindparam("c"),
+        participants.c.last_read_message_id < new_pointer,
+        new_pointer <= last_message_id,
+    )
+    .values(
+        last_read_message_id=new_pointer,
+        unread_count=case((new_pointer == last_message_id, 0), (still_unread > 0, still_unread), else_=0),
+    )
+)
+
+
+class ReadReceiptBuffer:
+    def __init__(self, interval: float = READ_FLUSH_INTERVAL, known_size: int = READ_KNOWN_POINTERS):
+        self.interval = interval
+        self.known_size = known_size
+        # (user_id, chat_id) -> highest message id read since the last flush
+        self._pending: dict[tuple[int, int], int] = {}
+        # the batch being written, still ahead of what readers of the table see
+        self._flushing: dict[tuple[int, int], int] = {}
+        # (user_id, chat_id) -> highest id seen, pending or flushed, least recently used first
+        self._known: OrderedDict[tuple[int, int], int] = OrderedDict()
+        self.marks = 0
+        self.flushed = 0
+        self._task: asyncio.Task | None = None
+        self._stopping: asyncio.Event | None = None
+
+    def start(self):
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+
+        # a flush in progress runs to the end, the loop then writes what was marked since and exits
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+    def mark(self, user_id: int, chat_id: int, message_id: int) -> bool:
+        # True when the pointer moved, any number of marks between flushes cost one row update
+        key = (user_id, chat_id)
+        self.marks += 1
+        if message_id <= self._known.get(key, 0):
+            return False
+
+        self._pending[key] = message_id
+        self.remember(user_id, chat_id, message_id)
+        return True
+
+    def remember(self, user_id: int, chat_id: int, message_id: int):
+        # a pointer already stored, known so reads behind it are answered without the database
+        key = (user_id, chat_id)
+        self._known[key] = max(message_id, self._known.get(key, 0))
+        self._known.move_to_end(key)
+        while len(self._known) > self.known_size:
+            self._known.popitem(last=False)
+
+    def latest(self, user_id: int, chat_id: int, default: int = 0) -> int:
+        return self._known.get((user_id, chat_id), default)
+
+    def pending_for(self, user_id: int) -> dict[int, int]:
+        return {chat_id: message_id for (pending_user, chat_id), message_id in self._unflushed() if pending_user == user_id}
+
+    def pending_in(self, chat_id: int) -> dict[int, int]:
+        return {user_id: message_id for (user_id, pending_chat), message_id in self._unflushed() if pending_chat == chat_id}
+
+    def _unflushed(self):
+        # pending entries come last, they are never behind the batch in flight
+        return [*self._flushing.items(), *self._pending.items()]
+
+    def forget_user(self, user_id: int):
+        for key in [key for key in self._known if key[0] == user_id]:
+            del self._known[key]
+        for key in [key for key in self._pending if key[0] == user_id]:
+            del self._pending[key]
+
+    async def flush(self):
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, {}
+        self._flushing = batch
+        # rows locked in one order on every node, so concurrent flushes can't deadlock
+        rows = [{"u": user_id, "c": chat_id, "m": message_id} for (user_id, chat_id), message_id in sorted(batch.items(), key=lambda item: (item[0][1], item[0][0]))]
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(ADVANCE_READ_POINTER, rows)
+                await db.commit()
+        except Exception:
+            logger.exception("Failed to flush %s read pointers", len(rows))
+            # retried with the next flush, anything read since then wins
+            for key, message_id in batch.items():
+                if message_id > self._pending.get(key, 0):
+                    self._pending[key] = message_id
+            return
+        finally:
+            self._flushing = {}
+        self.flushed += len(rows)
+
+    def stats(self):
+        return {"pending": len(self._pending), "known": len(self._known), "marks": self.marks, "flushed": self.flushed}
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+
+read_receipts = ReadReceiptBuffer()
+
+
+async def record_read(user_id: int, chat_id: int, message_id: int) -> int | None:
+    # the user's pointer afterwards, None when message_id is not a message of the chat
+    latest = read_receipts.latest(user_id, chat_id)
+    if message_id <= latest:
+        return latest
+
+    # one indexed read for a pointer that would move, an unknown id must not get stuck in the buffer
+    async with AsyncSessionLocal() as db:
+        row = (await db.execute(
+            select(Message.id, ChatParticipant.last_read_message_id)
+            .select_from(ChatParticipant)
+            .outerjoin(Message, and_(Message.id == message_id, Message.chat_id == chat_id))
+            .where(ChatParticipant.user_id == user_id, ChatParticipant.chat_id == chat_id)
+        )).first()
+    if row is None or row[0] is None:
+        return None
+
+    stored = row[1]
+    if message_id <= stored:
+        read_receipts.remember(user_id, chat_id, stored)
+        return stored
+
+    if not read_receipts.mark(user_id, chat_id, message_id):
+        return read_receipts.latest(user_id, chat_id)
+
+    chat_list_cache.on_read(user_id, chat_id, message_id)
+    await manager.broadcast(
+        chat_id,
+        {"action": "read", "chat_id": chat_id, "user_id": user_id, "message_id": message_id},
+        coalesce_key=("read", chat_id, user_id),
+    )
+    return message_id
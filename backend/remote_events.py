@@ -0,0 +1,26 @@
+# a new message event carries no action, it is routed under this name
+MESSAGE_CREATED = "message"
+
+
+class RemoteEvents:
+    # routes events published on other workers to the local caches their writes never went through
+    def __init__(self):
+        self._handlers: dict[str, list] = {}
+
+    def on(self, action: str, handler):
+        self._handlers.setdefault(action, []).append(handler)
+
+    def __call__(self, chat_id: int, message):
+        if not isinstance(message, dict):
+            return
+
+        action = message.get("action")
+        if action is None:
+            if message.get("sender_id") is None:
+                return
+            action = MESSAGE_CREATED
+        for handler in self._handlers.get(action, ()):
+            handler(chat_id, message)
+
+
+remote_events = RemoteEvents()
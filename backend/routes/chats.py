@@ -1,44 +1,76 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import func
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.exc import IntegrityError
 
-from database import get_db, User, Chat, ChatParticipant
-from models import CreateChatRequest
+from database import get_db, User, Chat, ChatParticipant, DirectChat, Message
+from models import CreateChatRequest, CreateChatResponse, ChatList, ReadRequest, ReadResponse, ReceiptList
 from auth import get_current_user
 from utils import security
+from chat_cache import chat_list_cache, message_summary
+from membership import membership
+from websocket import manager
+from history import export_chat, gzip_chunks
+from receipts import read_receipts, record_read
 
 
 router = APIRouter()
 
-@router.post("/chats")
-def create_chat(request_data: CreateChatRequest, current_user=Depends(get_current_user), db=Depends(get_db), credentials=Depends(security)):
-    other_user = db.query(User).filter(User.username == request_data.username).first()
+@router.post("/chats", response_model=CreateChatResponse, response_model_exclude_none=True)
+async def create_chat(request_data: CreateChatRequest, current_user=Depends(get_current_user), db=Depends(get_db), credentials=Depends(security)):
+    other_user = await db.scalar(select(User).where(User.username == request_data.username))
 
     if not other_user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    existing_chat = (
-        db.query(Chat)
-        .join(ChatParticipant)
-        .filter(ChatParticipant.user_id.in_([current_user.id, other_user.id]))
-        .group_by(Chat.id)
-        .having(func.count(Chat.id) == 2)
-        .first()
-    )
+    if other_user.id == current_user.id:
+        raise HTTPException(status_code=400, detail="Can't start a chat with yourself")
+
+    user_low_id, user_high_id = sorted((current_user.id, other_user.id))
+    pair = (DirectChat.user_low_id == user_low_id, DirectChat.user_high_id == user_high_id)
+
+    existing_chat_id = await db.scalar(select(DirectChat.chat_id).where(*pair))
 
-    if existing_chat:
-        return {"chat_id": existing_chat.id, "message": "Chat already exists"}
+    if existing_chat_id:
+        return {"chat_id": existing_chat_id, "message": "Chat already exists"}
 
     new_chat = Chat()
     db.add(new_chat)
-    db.commit()
-    db.refresh(new_chat)
+    await db.flush()
 
-    participants = [
+    db.add_all([
+        DirectChat(user_low_id=user_low_id, user_high_id=user_high_id, chat_id=new_chat.id),
         ChatParticipant(chat_id=new_chat.id, user_id=current_user.id),
         ChatParticipant(chat_id=new_chat.id, user_id=other_user.id),
-    ]
-    db.add_all(participants)
-    db.commit()
+    ])
+
+    try:
+        await db.commit()
+    except IntegrityError:
+        # the other user opened the same DM concurrently, the pair's primary key let only one through
+        await db.rollback()
+        existing_chat_id = await db.scalar(select(DirectChat.chat_id).where(*pair))
+        if existing_chat_id is None:
+            raise HTTPException(status_code=500, detail="Error creating chat")
+        return {"chat_id": existing_chat_id, "message": "Chat already exists"}
+
+    membership.add_chat(new_chat.id, [current_user.id, other_user.id])
+    # members already on /ws start receiving the new chat without reconnecting
+    await manager.add_chat(new_chat.id, [current_user.id, other_user.id])
+
+    chat_list_cache.add_chat(
+        {
+            "chat_id": new_chat.id,
+            "participants": [
+                {"id": user.id, "username": user.username, "display_name": user.display_name}
+                for user in (current_user, other_user)
+            ],
+            "last_message": None,
+            "unread_count": 0,
+            "last_read_message_id": 0,
+        },
+        [current_user.id, other_user.id],
+    )
 
     return {
         "chat_id": new_chat.id,
@@ -49,31 +81,139 @@ def create_chat(request_data: CreateChatRequest, current_user=Depends(get_curren
     }
 
 
-@router.get("/chats")
-def get_chats(db=Depends(get_db), current_user=Depends(get_current_user), credentials=Depends(security)):
-    chats = (
-        db.query(Chat)
-        .join(ChatParticipant)
-        .filter(ChatParticipant.user_id == current_user.id)
-        .all()
+async def count_read(db, user_id: int, ranges: dict[int, tuple[int, int]]) -> dict[int, int]:
+    # messages between the stored and the buffered pointer, only the slice read since the last flush is scanned
+    if not ranges:
+        return {}
+    return dict((await db.execute(
+        select(Message.chat_id, func.count(Message.id))
+        .where(
+            or_(*(and_(Message.chat_id == chat_id, Message.id > low, Message.id <= high) for chat_id, (low, high) in ranges.items())),
+            Message.sender_id.is_distinct_from(user_id),
+        )
+        .group_by(Message.chat_id)
+    )).all())
+
+
+async def load_chat_list(db, user_id: int):
+    # taken before the query, a flush landing in between is then seen by one side or the other
+    buffered = read_receipts.pending_for(user_id)
+    user_chats = select(ChatParticipant.chat_id).where(ChatParticipant.user_id == user_id)
+
+    # one backward probe of ix_messages_chat_id_id per chat, a GROUP BY max would scan every message of every chat
+    last_id = (
+        select(Message.id)
+        .where(Message.chat_id == ChatParticipant.chat_id)
+        .order_by(Message.id.desc())
+        .limit(1)
+        .correlate(ChatParticipant)
+        .scalar_subquery()
     )
 
-    result = []
-    for chat in chats:
-        participants = (
-            db.query(User)
-            .join(ChatParticipant)
-            .filter(ChatParticipant.chat_id == chat.id)
-            .all()
-        )
-        result.append({
-            "chat_id": chat.id,
-            "participants": [
-                {
-                "id": user.id,
-                "username": user.username,
-                "display_name": user.display_name
-            } for user in participants ]
+    # unread counts are kept on the participant rows, nothing past the pointer is counted here
+    rows = (await db.execute(
+        select(ChatParticipant.chat_id, Message, ChatParticipant.last_read_message_id, ChatParticipant.unread_count)
+        .outerjoin(Message, Message.id == last_id)
+        .where(ChatParticipant.user_id == user_id)
+    )).all()
+
+    # reads still waiting in the buffer are ahead of the stored pointers and counters
+    last_read = {chat_id: last_read_id for chat_id, _, last_read_id, _ in rows}
+    unread = {chat_id: unread_count for chat_id, _, _, unread_count in rows}
+    newest = {chat_id: last_message.id for chat_id, last_message, _, _ in rows if last_message}
+    pending = {chat_id: message_id for chat_id, message_id in buffered.items() if message_id > last_read.get(chat_id, message_id)}
+    # caught up to the last message clears the counter, as the flush will
+    behind = {chat_id: message_id for chat_id, message_id in pending.items() if message_id < newest.get(chat_id, 0)}
+    read_since = await count_read(db, user_id, {chat_id: (last_read[chat_id], message_id) for chat_id, message_id in behind.items()})
+    for chat_id in pending:
+        unread[chat_id] = max(unread[chat_id] - read_since.get(chat_id, 0), 0) if chat_id in behind else 0
+    last_read.update(pending)
+
+    participants = (await db.execute(
+        select(ChatParticipant.chat_id, User)
+        .join(User, User.id == ChatParticipant.user_id)
+        .where(ChatParticipant.chat_id.in_(user_chats))
+        .order_by(ChatParticipant.chat_id, ChatParticipant.id)
+    )).all()
+
+    participants_by_chat = {}
+    for chat_id, user in participants:
+        participants_by_chat.setdefault(chat_id, []).append({
+            "id": user.id,
+            "username": user.username,
+            "display_name": user.display_name
         })
 
-    return {"chats": result}
\ No newline at end of file
+    return [
+        {
+            "chat_id": chat_id,
+            "participants": participants_by_chat.get(chat_id, []),
+            "last_message": message_summary(last_message) if last_message else None,
+            "unread_count": unread[chat_id],
+            "last_read_message_id": last_read[chat_id],
+        }
+        for chat_id, last_message, _, _ in rows
+    ]
+
+
+@router.get("/chats", response_model=ChatList)
+async def get_chats(db=Depends(get_db), current_user=Depends(get_current_user), credentials=Depends(security)):
+    result = chat_list_cache.get(current_user.id)
+
+    if result is None:
+        # a send or read landing while the list loads keeps the loaded list out of the cache
+        fill = chat_list_cache.begin_fill(current_user.id)
+        result = chat_list_cache.set(current_user.id, await load_chat_list(db, current_user.id), fill)
+
+    return ORJSONResponse({"chats": result})
+
+
+@router.get("/chats/{chat_id}/export")
+async def export_chat_history(
+    chat_id: int,
+    format: str = Query("ndjson", pattern="^(ndjson|gzip)$"),
+    current_user=Depends(get_current_user),
+    credentials=Depends(security)
+):
+    await membership.require_member(chat_id, current_user.id)
+
+    if format == "gzip":
+        return StreamingResponse(
+            gzip_chunks(export_chat(chat_id)),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f'attachment; filename="chat-{chat_id}.ndjson.gz"'},
+        )
+    return StreamingResponse(
+        export_chat(chat_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="chat-{chat_id}.ndjson"'},
+    )
+
+
+@router.post("/chats/{chat_id}/read", response_model=ReadResponse)
+async def mark_chat_read(chat_id: int, request_data: ReadRequest, current_user=Depends(get_current_user), credentials=Depends(security)):
+    await membership.require_member(chat_id, current_user.id)
+
+    # buffered, the pointer reaches the database with the next flush
+    last_read = await record_read(current_user.id, chat_id, request_data.message_id)
+    if last_read is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return {"chat_id": chat_id, "last_read_message_id": last_read}
+
+
+@router.get("/chats/{chat_id}/receipts", response_model=ReceiptList)
+async def get_chat_receipts(chat_id: int, current_user=Depends(get_current_user), db=Depends(get_db), credentials=Depends(security)):
+    await membership.require_member(chat_id, current_user.id)
+
+    buffered = read_receipts.pending_in(chat_id)
+    stored = dict((await db.execute(
+        select(ChatParticipant.user_id, ChatParticipant.last_read_message_id).where(ChatParticipant.chat_id == chat_id)
+    )).all())
+    for user_id, message_id in buffered.items():
+        if user_id in stored and message_id > stored[user_id]:
+            stored[user_id] = message_id
+
+    return ORJSONResponse({
+        "chat_id": chat_id,
+        "receipts": [{"user_id": user_id, "last_read_message_id": message_id} for user_id, message_id in sorted(stored.items())],
+    })
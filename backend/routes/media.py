@@ -0,0 +1,143 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse
+from sqlalchemy import select
+
+import os
+import re
+
+from database import get_db, Message
+from auth import authenticate_token
+from membership import membership
+from thumbnails import variant_generator, IMAGE_HASH_RE, VARIANT_SIZES, SOURCE_EXTS
+from uploads import verify_media_url
+from utils import UPLOAD_DIR, etag_matches
+
+
+# set to an nginx `internal` location aliased to the uploads dir to let nginx sendfile() the body
+MEDIA_ACCEL_PREFIX = os.getenv("MEDIA_ACCEL_PREFIX")
+
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+MEDIA_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+CONTENT_ADDRESSED_RE = re.compile(r"^([0-9a-f]{64})(\.[a-z]+)$")
+
+router = APIRouter()
+
+
+async def get_media_user(request: Request, token: str | None, db):
+    # URLs from before signing carry the session token as ?token=, <img> tags can't send a header
+    auth_header = request.headers.get("Authorization")
+    if auth_header and auth_header.startswith("Bearer "):
+        token = auth_header.split(" ")[1]
+
+    if not token:
+        raise HTTPException(status_code=401, detail="Missing or invalid token")
+
+    return await authenticate_token(token, db)
+
+
+async def require_image_access(db, user_id: int, image_hash: str = None, image_url: str = None):
+    chat_ids = await membership.chats_of(user_id)
+    if chat_ids:
+        condition = Message.image_hash == image_hash if image_hash else Message.image_url == image_url
+        message_id = await db.scalar(
+            select(Message.id).where(condition, Message.chat_id.in_(chat_ids)).limit(1)
+        )
+        if message_id is not None:
+            return
+
+    # same answer as a missing file, so hashes can't be probed
+    raise HTTPException(status_code=404, detail="Image not found")
+
+
+async def require_media_access(request: Request, db, path: str, exp: int | None, sig: str | None, token: str | None, **image):
+    # a signed URL was handed to a chat member in a message payload, it is access on its own
+    if verify_media_url(path, exp, sig):
+        return
+
+    user = await get_media_user(request, token, db)
+    await require_image_access(db, user.id, **image)
+
+
+def file_response(request: Request, path, etag: str, immutable: bool, media_type: str = None):
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL,
+    }
+
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    if MEDIA_ACCEL_PREFIX:
+        relative = os.path.relpath(path, UPLOAD_DIR).replace(os.sep, "/")
+        headers["X-Accel-Redirect"] = MEDIA_ACCEL_PREFIX.rstrip("/") + "/" + relative
+        return Response(headers=headers, media_type=media_type)
+
+    # handles Range/If-Range itself and uses http.response.pathsend when the server offers it
+    return FileResponse(path, headers=headers, media_type=media_type)
+
+
+@router.get("/uploads/{filename}")
+async def get_upload(
+    filename: str,
+    request: Request,
+    exp: int = Query(None),
+    sig: str = Query(None),
+    token: str = Query(None),
+    db=Depends(get_db)
+):
+    match = CONTENT_ADDRESSED_RE.match(filename)
+    if match and match.group(2) in SOURCE_EXTS:
+        image_hash, ext = match.groups()
+        await require_media_access(request, db, f"/uploads/{filename}", exp, sig, token, image_hash=image_hash)
+    elif not filename.startswith("."):
+        # uploads from before content addressing are only reachable through their message's image_url
+        image_hash, ext = None, os.path.splitext(filename)[1].lower()
+        await require_media_access(request, db, f"/uploads/{filename}", exp, sig, token, image_url=f"/uploads/{filename}")
+    else:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    path = UPLOAD_DIR / filename
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    if image_hash:
+        return file_response(request, path, f'"{image_hash}"', True, MEDIA_TYPES.get(ext))
+    return file_response(request, path, f'"{int(stat.st_mtime):x}-{stat.st_size:x}"', False, MEDIA_TYPES.get(ext))
+
+
+@router.get("/media/{image_hash}/{variant}")
+async def get_image_variant(
+    image_hash: str,
+    variant: str,
+    request: Request,
+    exp: int = Query(None),
+    sig: str = Query(None),
+    token: str = Query(None),
+    db=Depends(get_db)
+):
+    if not IMAGE_HASH_RE.match(image_hash) or variant not in VARIANT_SIZES:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    await require_media_access(request, db, f"/media/{image_hash}/{variant}", exp, sig, token, image_hash=image_hash)
+
+    etag = f'"{image_hash}-{variant}"'
+    if etag_matches(request, etag):
+        return file_response(request, None, etag, True)
+
+    try:
+        path = await variant_generator.ensure(image_hash, variant)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    except Exception:
+        raise HTTPException(status_code=422, detail="Image could not be processed")
+
+    return file_response(request, path, etag, True, "image/webp")
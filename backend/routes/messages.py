@@ -1,20 +1,46 @@
 from fastapi import APIRouter, Depends, HTTPException, Query, UploadFile, File, Form
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import select
 
-import os
-import shutil
 from datetime import datetime
 
-from database import get_db, User, Message, Chat, ChatParticipant
-from models import MessageEdit
+from database import get_db, User, Message
+from models import MessageEdit, SendMessageResponse, MessagesPage, SearchPage, DeleteMessageResponse, EditMessageResponse
 from auth import get_current_user
-from utils import UPLOAD_DIR
+from utils import encode_cursor, decode_cursor
 from websocket import manager
 from utils import security
+from chat_cache import chat_list_cache, message_summary
+from message_cache import message_cache
+from membership import membership
+from uploads import store_image, upload_url, signed_media_url
+from thumbnails import variant_generator, variant_urls
+from search import search_messages
+from changelog import record_changes, add_unread, remove_unread, CHANGE_CREATE, CHANGE_EDIT, CHANGE_DELETE
+from receipts import read_receipts
 
 
 router = APIRouter()
 
-@router.post("/messages")
+
+def message_event(msg, sender, seq=None):
+    return {
+        "id": msg.id,
+        "seq": seq,
+        "chat_id": msg.chat_id,
+        "sender_id": msg.sender_id,
+        "content": msg.content,
+        "reply_content": msg.reply_content,
+        "image_url": signed_media_url(msg.image_url),
+        "image_hash": msg.image_hash,
+        **variant_urls(msg.image_hash),
+        "sent_time": msg.sent_time.isoformat(),
+        "sender_username": sender.username,
+        "sender_display_name": sender.display_name
+    }
+
+
+@router.post("/messages", response_model=SendMessageResponse)
 async def send_message(
     chat_id: int = Form(...),
     content: str = Form(None),
@@ -24,127 +50,241 @@ async def send_message(
     db=Depends(get_db),
     credentials=Depends(security)
 ):
-    chat = db.query(Chat).filter(Chat.id == chat_id).first()
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-
-    participant = db.query(ChatParticipant).filter(
-        ChatParticipant.chat_id == chat.id,
-        ChatParticipant.user_id == current_user.id
-    ).first()
-    if not participant:
-        raise HTTPException(status_code=403, detail="User not a participant of the chat")
-
-    image_url = None
+    await membership.require_member(chat_id, current_user.id)
+
+    image_url = image_hash = None
     if image:
-        file_path = os.path.join(UPLOAD_DIR, image.filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
-        image_url = f"/uploads/{image.filename}"
+        image_hash, ext = await store_image(image)
+        image_url = upload_url(image_hash, ext)
+        variant_generator.prefetch(image_hash)
 
     if not content and not image_url:
         raise HTTPException(status_code=400, detail="Message cannot be empty")
 
     new_message = Message(
-        chat_id=chat.id,
+        chat_id=chat_id,
         sender_id=current_user.id,
-        content=content,
+        content=content or "",
         reply_content=reply_content,
         image_url=image_url,
+        image_hash=image_hash,
         sent_time=datetime.utcnow()
     )
     db.add(new_message)
-    db.commit()
-    db.refresh(new_message)
-
-    message_data = {
-        "id": new_message.id,
-        "chat_id": new_message.chat_id,
-        "sender_id": new_message.sender_id,
-        "content": new_message.content,
-        "reply_content": new_message.reply_content,
-        "image_url": new_message.image_url,
-        "sent_time": new_message.sent_time.isoformat(),
-        "sender_username": current_user.username
-    }
-    await manager.broadcast(chat.id, message_data)
+    await db.flush()
+    [seq] = await record_changes(db, chat_id, [(new_message.id, CHANGE_CREATE)])
+    await add_unread(db, chat_id, [current_user.id])
+    await db.commit()
+    await db.refresh(new_message)
+
+    chat_list_cache.on_message_created(message_summary(new_message))
+    message_cache.on_message_created(serialize_message(new_message, current_user))
+    read_receipts.mark(current_user.id, chat_id, new_message.id)
+
+    message_data = message_event(new_message, current_user, seq)
+    await manager.broadcast(chat_id, message_data)
 
     return {"message": "Message sent successfully", "message_details": message_data}
 
 
-@router.get("/messages")
-def get_messages_in_chat(chat_id: int = Query(...), current_user=Depends(get_current_user), db=Depends(get_db), credentials=Depends(security)):
-    chat = db.query(Chat).filter(Chat.id == chat_id).first()
-    
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-
-    participant = db.query(ChatParticipant).filter(
-        ChatParticipant.chat_id == chat.id,
-        ChatParticipant.user_id == current_user.id
-    ).first()
-
-    if not participant:
-        raise HTTPException(status_code=403, detail="User not a participant of the chat")
-
-    messages = db.query(Message).filter(Message.chat_id == chat.id).order_by(Message.sent_time).all()
-
-    result = []
-    for msg in messages:
-        sender = db.query(User).filter(User.id == msg.sender_id).first()
-        
-        result.append({
-            "id": msg.id,
-            "chat_id": msg.chat_id,
-            "content": msg.content,
-            "reply_content": msg.reply_content,
-            "sent_time": msg.sent_time,
-            "image_url": msg.image_url,
-            "sender": {
-                "id": sender.id,
-                "username": sender.username,
-                "display_name": sender.display_name
-            }
-        })
-
-    return {"messages": result}
-
-
-@router.delete("/messages/{message_id}")
+MESSAGES_PAGE_DEFAULT = 50
+MESSAGES_PAGE_MAX = 200
+
+
+def serialize_message(msg, sender):
+    return {
+        "id": msg.id,
+        "chat_id": msg.chat_id,
+        "content": msg.content,
+        "reply_content": msg.reply_content,
+        "sent_time": msg.sent_time,
+        "image_url": signed_media_url(msg.image_url),
+        "image_hash": msg.image_hash,
+        **variant_urls(msg.image_hash),
+        "sender": {
+            "id": sender.id,
+            "username": sender.username,
+            "display_name": sender.display_name
+        } if sender else None
+    }
+
+
+def messages_page(chat_id: int, result: list[dict], has_more: bool, after_id: int | None):
+    older = newer = None
+    if result:
+        if after_id is not None or has_more:
+            older = encode_cursor({"chat_id": chat_id, "before_id": result[0]["id"]})
+        newer = encode_cursor({"chat_id": chat_id, "after_id": result[-1]["id"]})
+    elif after_id is not None:
+        newer = encode_cursor({"chat_id": chat_id, "after_id": after_id})
+
+    # returned as a response so history skips FastAPI's validate-and-encode pass, the model documents it
+    return ORJSONResponse({
+        "messages": result,
+        "has_more": has_more,
+        "cursors": {"before": older, "after": newer},
+    })
+
+
+@router.get("/messages", response_model=MessagesPage)
+async def get_messages_in_chat(
+    chat_id: int = Query(...),
+    before_id: int = Query(None),
+    after_id: int = Query(None),
+    cursor: str = Query(None),
+    limit: int = Query(MESSAGES_PAGE_DEFAULT, ge=1, le=MESSAGES_PAGE_MAX),
+    current_user=Depends(get_current_user),
+    db=Depends(get_db),
+    credentials=Depends(security)
+):
+    if cursor:
+        data = decode_cursor(cursor)
+        if data.get("chat_id") != chat_id:
+            raise HTTPException(status_code=400, detail="Cursor does not belong to this chat")
+        before_id = data.get("before_id")
+        after_id = data.get("after_id")
+        if any(value is not None and type(value) is not int for value in (before_id, after_id)):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id, not both")
+
+    await membership.require_member(chat_id, current_user.id)
+
+    # the first page of recent history comes from the hot window when the chat has one
+    first_page = before_id is None and after_id is None
+    if first_page and limit <= message_cache.window_size:
+        cached = message_cache.latest(chat_id, limit)
+        if cached is not None:
+            result, has_more = cached
+            return messages_page(chat_id, result, has_more, None)
+
+    # ids are monotonic per insert, so they give a stable keyset even when sent_time collides
+    query = (
+        select(Message, User)
+        .outerjoin(User, User.id == Message.sender_id)
+        .where(Message.chat_id == chat_id)
+    )
+
+    if first_page and limit <= message_cache.window_size:
+        # load the whole window once so the following first pages are hits
+        fill_token = message_cache.begin_fill(chat_id)
+        rows = (await db.execute(query.order_by(Message.id.desc()).limit(message_cache.window_size + 1))).all()
+        window = [serialize_message(msg, sender) for msg, sender in rows[::-1]]
+        message_cache.fill(chat_id, fill_token, window, len(rows) <= message_cache.window_size)
+        return messages_page(chat_id, window[-limit:], len(rows) > limit, None)
+
+    if after_id is not None:
+        rows = (await db.execute(query.where(Message.id > after_id).order_by(Message.id.asc()).limit(limit + 1))).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        if before_id is not None:
+            query = query.where(Message.id < before_id)
+        rows = (await db.execute(query.order_by(Message.id.desc()).limit(limit + 1))).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit][::-1]
+
+    result = [serialize_message(msg, sender) for msg, sender in rows]
+    return messages_page(chat_id, result, has_more, after_id)
+
+
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_PAGE_MAX = 50
+SEARCH_MAX_OFFSET = 1000
+
+
+@router.get("/messages/search", response_model=SearchPage)
+async def search_messages_in_chats(
+    q: str = Query(..., min_length=1, max_length=200),
+    chat_id: int = Query(None),
+    cursor: str = Query(None),
+    limit: int = Query(SEARCH_PAGE_DEFAULT, ge=1, le=SEARCH_PAGE_MAX),
+    current_user=Depends(get_current_user),
+    db=Depends(get_db),
+    credentials=Depends(security)
+):
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Search query cannot be empty")
+
+    offset = 0
+    if cursor:
+        data = decode_cursor(cursor)
+        if data.get("q") != q or data.get("chat_id") != chat_id or not isinstance(data.get("offset"), int):
+            raise HTTPException(status_code=400, detail="Cursor does not belong to this search")
+        offset = data["offset"]
+
+    if chat_id is not None:
+        await membership.require_member(chat_id, current_user.id)
+        chat_ids = {chat_id}
+    else:
+        chat_ids = await membership.chats_of(current_user.id)
+
+    results = []
+    if chat_ids and offset < SEARCH_MAX_OFFSET:
+        results = await search_messages(db, q, chat_ids, limit + 1, offset)
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = encode_cursor({"q": q, "chat_id": chat_id, "offset": offset + limit})
+
+    return ORJSONResponse({"results": results, "next_cursor": next_cursor})
+
+
+@router.delete("/messages/{message_id}", response_model=DeleteMessageResponse)
 async def delete_message(message_id: int, current_user=Depends(get_current_user), db=Depends(get_db), credentials=Depends(security)):
     try:
-        message = db.query(Message).filter(Message.id == message_id).first()
+        message = await db.scalar(select(Message).where(Message.id == message_id))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+
     if message.sender_id != current_user.id:
         raise HTTPException(status_code=403, detail="You can't delete this message")
 
     chat_id = message.chat_id
 
     try:
-        db.delete(message)
-        db.commit()
+        await db.delete(message)
+        [seq] = await record_changes(db, chat_id, [(message_id, CHANGE_DELETE)])
+        await remove_unread(db, chat_id, message_id, message.sender_id)
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+    previous = await db.scalar(
+        select(Message).where(Message.chat_id == chat_id).order_by(Message.id.desc()).limit(1)
+    )
+    chat_list_cache.on_message_deleted(
+        chat_id, message_id, message.sender_id, message_summary(previous) if previous else None
+    )
+    message_cache.on_message_deleted(chat_id, message_id)
+
     event = {
         "action": "delete_message",
-        "message_id": message_id
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "seq": seq
     }
     await manager.broadcast(chat_id, event)
 
     return {"message": "Message deleted successfully", "deleted_message": {"message_id": message.id, "content": message.content}}
 
 
-@router.patch("/messages/{message_id}")
-async def delete_message(message_id: int, new_message: MessageEdit, current_user=Depends(get_current_user), db=Depends(get_db), credentials=Depends(security)):
+@router.patch("/messages/{message_id}", response_model=EditMessageResponse)
+async def edit_message(message_id: int, new_message: MessageEdit, current_user=Depends(get_current_user), db=Depends(get_db), credentials=Depends(security)):
     try:
-        message = db.query(Message).filter(Message.id == message_id).first()
+        message = await db.scalar(select(Message).where(Message.id == message_id))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+
     if message.sender_id != current_user.id:
         raise HTTPException(status_code=403, detail="You can't delete this message")
 
@@ -153,17 +293,23 @@ async def delete_message(message_id: int, new_message: MessageEdit, current_user
     chat_id = message.chat_id
 
     try:
-        db.commit()
-        db.refresh(message)
+        [seq] = await record_changes(db, chat_id, [(message.id, CHANGE_EDIT)])
+        await db.commit()
+        await db.refresh(message)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+    chat_list_cache.on_message_edited(chat_id, message.id, message.content)
+    message_cache.on_message_edited(chat_id, message.id, message.content)
+
     event = {
         "action": "edit_message",
+        "chat_id": chat_id,
         "message_id": message.id,
-        "new_content": message.content
+        "new_content": message.content,
+        "seq": seq
     }
-    await manager.broadcast(chat_id, event)
+    await manager.broadcast(chat_id, event, coalesce_key=("edit_message", message.id))
 
     return {"message": "Message edited successfully", "edit_message": {"message_id": message.id, "content": message.content}}
\ No newline at end of file
@@ -0,0 +1,35 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse
+
+from auth import get_current_user
+from utils import security
+from membership import membership
+from models import PresencePage
+from websocket import manager
+
+
+PRESENCE_QUERY_MAX = 500
+
+router = APIRouter()
+
+
+@router.get("/presence", response_model=PresencePage)
+async def get_presence(
+    user_ids: list[int] = Query(None),
+    current_user=Depends(get_current_user),
+    credentials=Depends(security)
+):
+    # answered from memory, the chat list asks once for everyone it shows
+    if user_ids is not None and len(user_ids) > PRESENCE_QUERY_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {PRESENCE_QUERY_MAX} users per request")
+
+    # only people sharing a chat with the caller, others read as offline
+    chat_ids = await membership.chats_of(current_user.id)
+    contacts = set().union(*(await membership.members_of_chats(chat_ids)).values())
+    contacts.discard(current_user.id)
+
+    if user_ids is None:
+        user_ids = sorted(contacts)
+    snapshot = manager.presence.snapshot([user_id for user_id in dict.fromkeys(user_ids) if user_id in contacts], sorted(chat_ids))
+    snapshot["users"] += [{"user_id": user_id, "online": False, "last_seen": None} for user_id in dict.fromkeys(user_ids) if user_id not in contacts]
+    return ORJSONResponse(snapshot)
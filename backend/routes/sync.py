@@ -0,0 +1,73 @@
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import select
+
+from database import get_db, User, Message, ChatChange
+from auth import get_current_user
+from utils import security
+from membership import membership
+from models import SyncPage
+from changelog import CHANGE_CREATE, CHANGE_DELETE
+from routes.messages import serialize_message
+
+
+SYNC_PAGE_DEFAULT = 500
+SYNC_PAGE_MAX = 1000
+
+router = APIRouter()
+
+
+@router.get("/sync", response_model=SyncPage)
+async def sync_chat(
+    chat_id: int = Query(...),
+    since: int = Query(0, ge=0),
+    limit: int = Query(SYNC_PAGE_DEFAULT, ge=1, le=SYNC_PAGE_MAX),
+    current_user=Depends(get_current_user),
+    db=Depends(get_db),
+    credentials=Depends(security)
+):
+    await membership.require_member(chat_id, current_user.id)
+
+    # the log row carries the seq, the joined message carries its current state
+    rows = (await db.execute(
+        select(ChatChange, Message, User)
+        .outerjoin(Message, Message.id == ChatChange.message_id)
+        .outerjoin(User, User.id == Message.sender_id)
+        .where(ChatChange.chat_id == chat_id, ChatChange.seq > since)
+        .order_by(ChatChange.seq.asc())
+        .limit(limit + 1)
+    )).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # a message touched several times in the window is sent once, at its latest seq
+    latest = {}
+    created = set()
+    for change, msg, sender in rows:
+        latest[change.message_id] = (change, msg, sender)
+        if change.kind == CHANGE_CREATE:
+            created.add(change.message_id)
+
+    changes = []
+    for change, msg, sender in sorted(latest.values(), key=lambda row: row[0].seq):
+        if msg is None:
+            kind = CHANGE_DELETE
+        elif change.message_id in created:
+            kind = CHANGE_CREATE
+        else:
+            kind = change.kind
+
+        changes.append({
+            "seq": change.seq,
+            "kind": kind,
+            "message_id": change.message_id,
+            "message": serialize_message(msg, sender) if msg is not None else None,
+        })
+
+    return ORJSONResponse({
+        "chat_id": chat_id,
+        "changes": changes,
+        "since": rows[-1][0].seq if rows else since,
+        "has_more": has_more,
+    })
@@ -1,21 +1,33 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
-
-import bcrypt
+from sqlalchemy.orm import selectinload
 
 from database import get_db, User
-from models import UserCreate, UserLogin
+from models import UserCreate, UserLogin, RegisterResponse, TokenResponse, UserList, DeleteUserResponse
 from auth import create_access_token
+from chat_cache import chat_list_cache
+from message_cache import message_cache
+from auth_cache import auth_cache
+from membership import membership
+from websocket import manager
+from receipts import read_receipts
+from passwords import password_hasher
+from user_directory import search_users, user_search_cache, USER_PAGE_DEFAULT, USER_PAGE_MAX
+from utils import encode_cursor, decode_cursor, etag_matches
+
 
+# the directory changes under the cache, so clients revalidate and get a 304 while it hasn't
+USER_SEARCH_CACHE_CONTROL = "private, no-cache"
 
 router = APIRouter()
 
-@router.post("/register")
-def register(user: UserCreate, db=Depends(get_db)):
-    if db.query(User).filter(User.username == user.username).first():
+@router.post("/register", response_model=RegisterResponse)
+async def register(user: UserCreate, db=Depends(get_db)):
+    if await db.scalar(select(User).where(User.username == user.username)):
         raise HTTPException(status_code=409, detail="Username already exists")
 
-    hashed_password = bcrypt.hashpw(user.password.encode(), bcrypt.gensalt()).decode()
+    hashed_password = await password_hasher.hash(user.password)
 
     new_user = User(
         username=user.username,
@@ -26,51 +38,101 @@ def register(user: UserCreate, db=Depends(get_db)):
 
     try:
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
     except IntegrityError as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Error creating user, DB error: " + str(e))
 
+    user_search_cache.clear()
+
     return {"message": "User created successfully", "user": {"id": new_user.id, "username": new_user.username}}
 
 
-@router.post("/login")
-def login(user: UserLogin, db=Depends(get_db)):
-    db_user = db.query(User).filter(User.username == user.username).first()
+@router.post("/login", response_model=TokenResponse)
+async def login(user: UserLogin, db=Depends(get_db)):
+    db_user = await db.scalar(select(User).where(User.username == user.username))
 
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if not bcrypt.checkpw(user.password.encode(), db_user.password.encode()):
+    if not await password_hasher.verify(user.password, db_user.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
+    if password_hasher.needs_rehash(db_user.password):
+        # the work factor changed since this hash was made, upgrade it while we have the plain password
+        try:
+            db_user.password = await password_hasher.hash(user.password)
+            await db.commit()
+        except HTTPException:
+            pass
+
     access_token = create_access_token(data={"sub": db_user.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-@router.get("/users")
-def get_users(db=Depends(get_db)):
+@router.get("/users", response_model=UserList)
+async def get_users(
+    request: Request,
+    q: str = Query("", max_length=100),
+    cursor: str = Query(None),
+    limit: int = Query(USER_PAGE_DEFAULT, ge=1, le=USER_PAGE_MAX),
+    db=Depends(get_db)
+):
+    q = q.strip().lower()
+    key = (q, cursor, limit)
+
+    cached = user_search_cache.get(key)
+    if cached is None:
+        after = None
+        if cursor:
+            data = decode_cursor(cursor)
+            if data.get("q") != q or not isinstance(data.get("rank"), int) or not isinstance(data.get("username"), str):
+                raise HTTPException(status_code=400, detail="Cursor does not belong to this search")
+            after = (data["rank"], data["username"])
+
+        try:
+            rows = await search_users(db, q, after, limit + 1)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            rank, last = rows[-1]
+            next_cursor = encode_cursor({"q": q, "rank": rank, "username": last["username"]})
+
+        cached = user_search_cache.set(key, {"users": [user for _, user in rows], "next_cursor": next_cursor})
+
+    body, etag = cached
+    headers = {"ETag": etag, "Cache-Control": USER_SEARCH_CACHE_CONTROL}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@router.delete("/users/{user_id}", response_model=DeleteUserResponse)
+async def delete_user(user_id: int, db=Depends(get_db)):
     try:
-        users = db.query(User).all()
+        # cascades walk User.chats, which can't be lazy-loaded on an async session
+        user_exists = await db.scalar(select(User).options(selectinload(User.chats)).where(User.id == user_id))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    return {"users": [{"id": user.id, "username": user.username} for user in users]}
-
-
-@router.delete("/users/{user_id}")
-def delete_user(user_id: int, db=Depends(get_db)):
     try:
-        user_exists = db.query(User).filter(User.id == user_id).first()
+        await db.delete(user_exists)
+        await db.commit()
     except Exception as e:
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-    try:
-        db.delete(user_exists)
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
+    chat_list_cache.clear()
+    # cached pages still carry the deleted user as sender
+    message_cache.clear()
+    auth_cache.invalidate_user(user_id)
+    membership.remove_user(user_id)
+    read_receipts.forget_user(user_id)
+    user_search_cache.clear()
+    await manager.remove_user(user_id)
 
-    return {"message": "User deleted successfully", "deleted_user": {user_exists.username}}
\ No newline at end of file
+    return {"message": "User deleted successfully", "deleted_user": [user_exists.username]}
@@ -0,0 +1,117 @@
+from sqlalchemy import text, bindparam, DateTime
+
+import html
+import os
+
+
+# 'simple' skips stemming and stop words, which suits mixed-language chat history.
+# It has to match the config the search_vector column was generated with.
+SEARCH_CONFIG = os.getenv("SEARCH_CONFIG", "simple")
+
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+
+POSTGRES_SCHEMA = [
+    f"""
+    ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', coalesce(content, ''))) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_messages_search_vector ON messages USING gin (search_vector)",
+    # user directory: trigram indexes answer substring LIKEs, pattern_ops btrees the short prefix ones
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users USING gin (lower(username) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_display_name_trgm ON users USING gin (lower(display_name) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_prefix ON users (lower(username) text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_display_name_prefix ON users (lower(display_name) text_pattern_ops)",
+]
+
+# external-content FTS5 table, the triggers keep it in step with inserts, edits and deletes
+SQLITE_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id')",
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+POSTGRES_SEARCH = text(f"""
+    SELECT hit.id, hit.chat_id, hit.sent_time, hit.rank,
+           ts_headline('{SEARCH_CONFIG}', hit.content, hit.query,
+                       'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxWords=24, MinWords=8, MaxFragments=2') AS snippet,
+           u.id AS sender_id, u.username, u.display_name
+    FROM (
+        SELECT m.id, m.chat_id, m.sender_id, m.sent_time, m.content, q.query,
+               ts_rank_cd(m.search_vector, q.query) AS rank
+        FROM messages m, websearch_to_tsquery('{SEARCH_CONFIG}', :q) AS q(query)
+        WHERE m.search_vector @@ q.query AND m.chat_id IN :chat_ids
+        ORDER BY rank DESC, m.id DESC
+        LIMIT :limit OFFSET :offset
+    ) hit
+    LEFT JOIN users u ON u.id = hit.sender_id
+    ORDER BY hit.rank DESC, hit.id DESC
+""").bindparams(bindparam("chat_ids", expanding=True)).columns(sent_time=DateTime)
+
+SQLITE_SEARCH = text(f"""
+    SELECT m.id, m.chat_id, m.sent_time, -bm25(messages_fts) AS rank,
+           snippet(messages_fts, 0, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '…', 16) AS snippet,
+           u.id AS sender_id, u.username, u.display_name
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    LEFT JOIN users u ON u.id = m.sender_id
+    WHERE messages_fts MATCH :q AND m.chat_id IN :chat_ids
+    ORDER BY bm25(messages_fts), m.id DESC
+    LIMIT :limit OFFSET :offset
+""").bindparams(bindparam("chat_ids", expanding=True)).columns(sent_time=DateTime)
+
+
+def create_search_schema(connection):
+    statements = POSTGRES_SCHEMA if connection.dialect.name == "postgresql" else SQLITE_SCHEMA
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+def to_fts5_query(q: str) -> str:
+    # every word becomes a quoted phrase, so user input can't inject FTS5 operators
+    return " ".join('"' + word.replace('"', '""') + '"' for word in q.split())
+
+
+def safe_snippet(snippet: str | None) -> str:
+    escaped = html.escape(snippet or "")
+    return escaped.replace(html.escape(HIGHLIGHT_START), HIGHLIGHT_START).replace(html.escape(HIGHLIGHT_END), HIGHLIGHT_END)
+
+
+async def search_messages(db, q: str, chat_ids, limit: int, offset: int):
+    if db.bind.dialect.name == "postgresql":
+        statement = POSTGRES_SEARCH
+    else:
+        statement, q = SQLITE_SEARCH, to_fts5_query(q)
+
+    rows = (await db.execute(statement, {"q": q, "chat_ids": list(chat_ids), "limit": limit, "offset": offset})).all()
+
+    return [
+        {
+            "id": row.id,
+            "chat_id": row.chat_id,
+            "sent_time": row.sent_time,
+            "rank": float(row.rank),
+            "snippet": safe_snippet(row.snippet),
+            "sender": {
+                "id": row.sender_id,
+                "username": row.username,
+                "display_name": row.display_name
+            } if row.sender_id is not None else None
+        }
+        for row in rows
+    ]
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import uuid
+
+import pytest
+
+# settings are read when the app modules are imported, so they go in first
+TEST_DB_DIR = tempfile.mkdtemp(prefix="chat-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{TEST_DB_DIR}/test.db"
+os.environ["SECRET_KEY"] = "test-secret-key-not-used-anywhere-else"
+os.environ["BCRYPT_ROUNDS"] = "4"
+# read pointers are flushed by the tests themselves
+os.environ["READ_FLUSH_INTERVAL"] = "3600"
+
+from fastapi.testclient import TestClient
+
+import database
+from main import app
+from receipts import read_receipts
+
+
+@pytest.fixture(scope="session")
+def client():
+    database.init_db()
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def make_user(client):
+    # every test works with fresh users and chats, so they share one database
+    def make_user():
+        username = f"user_{uuid.uuid4().hex[:12]}"
+        response = client.post("/register", json={
+            "username": username,
+            "display_name": username.upper(),
+            "email": f"{username}@example.com",
+            "password": "password",
+        })
+        assert response.status_code == 200
+        token = client.post("/login", json={"username": username, "password": "password"}).json()["access_token"]
+        return {"id": response.json()["user"]["id"], "username": username, "token": token, "headers": {"Authorization": f"Bearer {token}"}}
+
+    return make_user
+
+
+@pytest.fixture
+def chat(client, make_user):
+    alice, bob = make_user(), make_user()
+    chat_id = client.post("/chats", json={"username": bob["username"]}, headers=alice["headers"]).json()["chat_id"]
+    return chat_id, alice, bob
+
+
+@pytest.fixture
+def send(client):
+    def send(chat_id, user, content="hello"):
+        response = client.post("/messages", data={"chat_id": chat_id, "content": content}, headers=user["headers"])
+        assert response.status_code == 200
+        return response.json()["message_details"]["id"]
+
+    return send
+
+
+@pytest.fixture
+def flush_reads(client):
+    def flush_reads():
+        client.portal.call(read_receipts.flush)
+
+    return flush_reads
@@ -0,0 +1,88 @@
+import pytest
+
+from message_cache import message_cache
+from utils import encode_cursor
+
+
+def get_page(client, chat_id, user, **params):
+    response = client.get("/messages", params={"chat_id": chat_id, **params}, headers=user["headers"])
+    assert response.status_code == 200
+    return response.json()
+
+
+def ids(page):
+    return [message["id"] for message in page["messages"]]
+
+
+def test_pages_backwards_through_history(client, chat, send):
+    chat_id, alice, _ = chat
+    sent = [send(chat_id, alice, f"m{i}") for i in range(7)]
+
+    page = get_page(client, chat_id, alice, limit=3)
+    seen = ids(page)
+    assert seen == sent[-3:]
+    while page["has_more"]:
+        page = get_page(client, chat_id, alice, limit=3, cursor=page["cursors"]["before"])
+        seen = ids(page) + seen
+
+    assert seen == sent
+    assert ids(page) == sent[:1]
+
+
+def test_after_cursor_returns_newer_messages(client, chat, send):
+    chat_id, alice, bob = chat
+    send(chat_id, alice)
+    page = get_page(client, chat_id, bob)
+
+    newer = [send(chat_id, alice, "late"), send(chat_id, bob, "later")]
+    page = get_page(client, chat_id, bob, cursor=page["cursors"]["after"])
+    assert ids(page) == newer
+    assert not page["has_more"]
+
+    # nothing new yet, the cursor keeps its place
+    empty = get_page(client, chat_id, bob, cursor=page["cursors"]["after"])
+    assert empty["messages"] == []
+    assert empty["cursors"]["after"] == page["cursors"]["after"]
+
+
+def test_first_page_from_hot_window_matches_database(client, chat, send):
+    chat_id, alice, _ = chat
+    for i in range(5):
+        send(chat_id, alice, f"m{i}")
+
+    cached = get_page(client, chat_id, alice, limit=3)
+    message_cache.invalidate_chat(chat_id)
+    loaded = get_page(client, chat_id, alice, limit=3)
+    assert cached == loaded
+
+
+@pytest.mark.parametrize("cursor", ["not a cursor!", encode_cursor(["chat_id"]), encode_cursor({"before_id": 1})])
+def test_rejects_malformed_cursors(client, chat, cursor):
+    chat_id, alice, _ = chat
+    response = client.get("/messages", params={"chat_id": chat_id, "cursor": cursor}, headers=alice["headers"])
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("fields", [{"before_id": [1]}, {"after_id": "3"}, {"before_id": True}, {"after_id": 1.5}])
+def test_rejects_cursor_ids_that_are_not_integers(client, chat, send, fields):
+    chat_id, alice, _ = chat
+    send(chat_id, alice)
+    cursor = encode_cursor({"chat_id": chat_id, **fields})
+    response = client.get("/messages", params={"chat_id": chat_id, "cursor": cursor}, headers=alice["headers"])
+    assert response.status_code == 400
+
+
+def test_rejects_cursor_of_another_chat(client, chat, make_user, send):
+    chat_id, alice, _ = chat
+    other = client.post("/chats", json={"username": make_user()["username"]}, headers=alice["headers"]).json()["chat_id"]
+    send(other, alice)
+    cursor = get_page(client, other, alice)["cursors"]["after"]
+
+    response = client.get("/messages", params={"chat_id": chat_id, "cursor": cursor}, headers=alice["headers"])
+    assert response.status_code == 400
+
+
+def test_rejects_before_and_after_together(client, chat):
+    chat_id, alice, _ = chat
+    response = client.get("/messages", params={"chat_id": chat_id, "before_id": 10, "after_id": 1}, headers=alice["headers"])
+    assert response.status_code == 400
@@ -0,0 +1,119 @@
+from sqlalchemy import func, select
+
+import database
+from database import ChatParticipant, Message
+from chat_cache import chat_list_cache
+
+
+def chat_entry(client, chat_id, user, cached=False):
+    if not cached:
+        chat_list_cache.invalidate_user(user["id"])
+    chats = client.get("/chats", headers=user["headers"]).json()["chats"]
+    return next(entry for entry in chats if entry["chat_id"] == chat_id)
+
+
+def mark_read(client, chat_id, user, message_id):
+    return client.post(f"/chats/{chat_id}/read", json={"message_id": message_id}, headers=user["headers"])
+
+
+def stored_counters(chat_id):
+    # (user_id, last_read_message_id, unread_count) rows next to the unread count recomputed from messages
+    with database.SessionLocal() as db:
+        rows = db.execute(
+            select(ChatParticipant.user_id, ChatParticipant.last_read_message_id, ChatParticipant.unread_count)
+            .where(ChatParticipant.chat_id == chat_id)
+        ).all()
+        return {
+            user_id: (unread_count, db.scalar(
+                select(func.count(Message.id))
+                .where(Message.chat_id == chat_id, Message.id > last_read, Message.sender_id.is_distinct_from(user_id))
+            ))
+            for user_id, last_read, unread_count in rows
+        }
+
+
+def assert_counters_match(chat_id):
+    for user_id, (stored, recounted) in stored_counters(chat_id).items():
+        assert stored == recounted, f"user {user_id}"
+
+
+def test_counts_messages_from_others(client, chat, send):
+    chat_id, alice, bob = chat
+    for i in range(3):
+        send(chat_id, alice, f"m{i}")
+
+    assert chat_entry(client, chat_id, bob)["unread_count"] == 3
+    assert chat_entry(client, chat_id, bob, cached=True)["unread_count"] == 3
+    assert chat_entry(client, chat_id, alice)["unread_count"] == 0
+    assert_counters_match(chat_id)
+
+
+def test_partial_read_before_and_after_flush(client, chat, send, flush_reads):
+    chat_id, alice, bob = chat
+    sent = [send(chat_id, alice, f"m{i}") for i in range(4)]
+
+    assert mark_read(client, chat_id, bob, sent[0]).json() == {"chat_id": chat_id, "last_read_message_id": sent[0]}
+    # still buffered, the list takes the pointer from the buffer
+    entry = chat_entry(client, chat_id, bob)
+    assert (entry["unread_count"], entry["last_read_message_id"]) == (3, sent[0])
+
+    flush_reads()
+    entry = chat_entry(client, chat_id, bob)
+    assert (entry["unread_count"], entry["last_read_message_id"]) == (3, sent[0])
+    assert_counters_match(chat_id)
+
+
+def test_reading_to_the_end_clears_the_counter(client, chat, send, flush_reads):
+    chat_id, alice, bob = chat
+    sent = [send(chat_id, alice, f"m{i}") for i in range(3)]
+
+    mark_read(client, chat_id, bob, sent[-1])
+    assert chat_entry(client, chat_id, bob)["unread_count"] == 0
+    flush_reads()
+    assert stored_counters(chat_id)[bob["id"]] == (0, 0)
+
+
+def test_deleting_an_unread_message_takes_it_off_the_counter(client, chat, send, flush_reads):
+    chat_id, alice, bob = chat
+    sent = [send(chat_id, alice, f"m{i}") for i in range(3)]
+    mark_read(client, chat_id, bob, sent[0])
+    flush_reads()
+
+    # already read, deleting it changes nothing
+    assert client.delete(f"/messages/{sent[0]}", headers=alice["headers"]).status_code == 200
+    assert chat_entry(client, chat_id, bob)["unread_count"] == 2
+    assert client.delete(f"/messages/{sent[1]}", headers=alice["headers"]).status_code == 200
+    assert chat_entry(client, chat_id, bob)["unread_count"] == 1
+    assert_counters_match(chat_id)
+
+
+def test_counts_websocket_sends(client, chat):
+    chat_id, alice, bob = chat
+    with client.websocket_connect(f"/ws?token={alice['token']}") as ws:
+        for i in range(2):
+            ws.send_json({"action": "send_message", "chat_id": chat_id, "content": f"ws{i}", "client_id": str(i)})
+        acks = 0
+        while acks < 2:
+            acks += ws.receive_json().get("action") == "ack"
+
+    assert chat_entry(client, chat_id, bob)["unread_count"] == 2
+    assert_counters_match(chat_id)
+
+
+def test_read_of_unknown_message_is_not_found(client, chat, make_user, send):
+    chat_id, alice, bob = chat
+    send(chat_id, alice)
+    other = client.post("/chats", json={"username": make_user()["username"]}, headers=alice["headers"]).json()["chat_id"]
+    elsewhere = send(other, alice)
+
+    assert mark_read(client, chat_id, bob, 10 ** 9).status_code == 404
+    assert mark_read(client, chat_id, bob, elsewhere).status_code == 404
+
+
+def test_read_behind_the_pointer_returns_the_pointer(client, chat, send, flush_reads):
+    chat_id, alice, bob = chat
+    first, second = send(chat_id, alice, "a"), send(chat_id, alice, "b")
+    mark_read(client, chat_id, bob, second)
+    flush_reads()
+
+    assert mark_read(client, chat_id, bob, first).json()["last_read_message_id"] == second
@@ -0,0 +1,68 @@
+def sync(client, chat_id, user, **params):
+    response = client.get("/sync", params={"chat_id": chat_id, **params}, headers=user["headers"])
+    assert response.status_code == 200
+    return response.json()
+
+
+def kinds(page):
+    return [(change["message_id"], change["kind"]) for change in page["changes"]]
+
+
+def test_each_message_appears_once_at_its_latest_state(client, chat, send):
+    chat_id, alice, bob = chat
+    kept, edited, deleted = send(chat_id, alice, "a"), send(chat_id, alice, "b"), send(chat_id, bob, "c")
+    client.patch(f"/messages/{edited}", json={"new_content": "b2"}, headers=alice["headers"])
+    client.delete(f"/messages/{deleted}", headers=bob["headers"])
+
+    page = sync(client, chat_id, alice)
+    # created inside the window, so the edit still reads as a create, with the edited content
+    assert kinds(page) == [(kept, "create"), (edited, "create"), (deleted, "delete")]
+    assert page["changes"][1]["message"]["content"] == "b2"
+    assert page["changes"][2]["message"] is None
+    assert page["since"] == page["changes"][-1]["seq"]
+    assert not page["has_more"]
+
+
+def test_changes_after_since_keep_their_kind(client, chat, send):
+    chat_id, alice, _ = chat
+    first, second = send(chat_id, alice, "a"), send(chat_id, alice, "b")
+    since = sync(client, chat_id, alice)["since"]
+
+    client.patch(f"/messages/{first}", json={"new_content": "a2"}, headers=alice["headers"])
+    client.delete(f"/messages/{second}", headers=alice["headers"])
+    page = sync(client, chat_id, alice, since=since)
+    assert kinds(page) == [(first, "edit"), (second, "delete")]
+
+    # caught up, the position stays put
+    assert sync(client, chat_id, alice, since=page["since"]) == {"chat_id": chat_id, "changes": [], "since": page["since"], "has_more": False}
+
+
+def test_pages_cover_the_log_without_gaps(client, chat, send):
+    chat_id, alice, _ = chat
+    sent = [send(chat_id, alice, f"m{i}") for i in range(5)]
+
+    seen, since, has_more = [], 0, True
+    while has_more:
+        page = sync(client, chat_id, alice, since=since, limit=2)
+        seen += [change["message_id"] for change in page["changes"]]
+        since, has_more = page["since"], page["has_more"]
+
+    assert seen == sent
+
+
+def test_deleted_newest_message_id_is_not_reused(client, chat, send):
+    chat_id, alice, _ = chat
+    send(chat_id, alice, "a")
+    newest = send(chat_id, alice, "b")
+    client.delete(f"/messages/{newest}", headers=alice["headers"])
+
+    replacement = send(chat_id, alice, "c")
+    assert replacement > newest
+    # the tombstone still names the deleted message, not the new one
+    assert kinds(sync(client, chat_id, alice))[-2:] == [(newest, "delete"), (replacement, "create")]
+
+
+def test_requires_membership(client, chat, make_user):
+    chat_id, _, _ = chat
+    response = client.get("/sync", params={"chat_id": chat_id}, headers=make_user()["headers"])
+    assert response.status_code == 403
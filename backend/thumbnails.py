@@ -0,0 +1,110 @@
+import asyncio
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from uploads import IMAGE_SIGNATURES, signed_media_url
+from utils import UPLOAD_DIR
+
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+# jobs allowed to wait for a worker at once, further requests wait on the event loop instead
+IMAGE_MAX_PENDING = int(os.getenv("IMAGE_MAX_PENDING", 32))
+
+VARIANT_SIZES = {
+    "thumb": 256,
+    "preview": 1024,
+}
+VARIANT_EXT = ".webp"
+VARIANTS_DIR = UPLOAD_DIR / "variants"
+os.makedirs(VARIANTS_DIR, exist_ok=True)
+
+IMAGE_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+SOURCE_EXTS = tuple(sorted({ext for _, ext in IMAGE_SIGNATURES} | {".webp"}))
+
+
+def render_variant(src_path: str, dst_path: str, max_size: int):
+    # runs in a worker process
+    from PIL import Image
+
+    Image.MAX_IMAGE_PIXELS = 50_000_000
+    with Image.open(src_path) as img:
+        img.draft("RGB", (max_size, max_size))
+        img.thumbnail((max_size, max_size))
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+
+        tmp_path = f"{dst_path}.{os.getpid()}.tmp"
+        img.save(tmp_path, "WEBP", quality=80, method=4)
+    os.replace(tmp_path, dst_path)
+
+
+def variant_path(image_hash: str, variant: str):
+    return VARIANTS_DIR / f"{image_hash}_{variant}{VARIANT_EXT}"
+
+
+def variant_urls(image_hash: str | None):
+    if not image_hash:
+        return {"thumbnail_url": None, "preview_url": None}
+    return {
+        "thumbnail_url": signed_media_url(f"/media/{image_hash}/thumb"),
+        "preview_url": signed_media_url(f"/media/{image_hash}/preview"),
+    }
+
+
+def find_original(image_hash: str):
+    for ext in SOURCE_EXTS:
+        path = UPLOAD_DIR / f"{image_hash}{ext}"
+        if path.exists():
+            return path
+    return None
+
+
+class VariantGenerator:
+    def __init__(self, workers: int = IMAGE_WORKERS, max_pending: int = IMAGE_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: ProcessPoolExecutor | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self._jobs: dict[tuple, asyncio.Future] = {}
+
+    async def ensure(self, image_hash: str, variant: str):
+        dst_path = variant_path(image_hash, variant)
+        if dst_path.exists():
+            return dst_path
+
+        key = (image_hash, variant)
+        job = self._jobs.get(key)
+        if job is None:
+            # concurrent requests for the same variant share one job
+            job = asyncio.ensure_future(self._generate(image_hash, variant, dst_path))
+            self._jobs[key] = job
+            job.add_done_callback(lambda _: self._jobs.pop(key, None))
+        return await asyncio.shield(job)
+
+    def prefetch(self, image_hash: str):
+        for variant in VARIANT_SIZES:
+            task = asyncio.ensure_future(self.ensure(image_hash, variant))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _generate(self, image_hash: str, variant: str, dst_path):
+        src_path = find_original(image_hash)
+        if src_path is None:
+            raise FileNotFoundError(image_hash)
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            self._slots = asyncio.Semaphore(self.workers + self.max_pending)
+
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, render_variant, str(src_path), str(dst_path), VARIANT_SIZES[variant])
+        return dst_path
+
+
+variant_generator = VariantGenerator()
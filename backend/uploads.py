@@ -0,0 +1,153 @@
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import ORJSONResponse
+from fastapi.concurrency import run_in_threadpool
+
+import base64
+import hashlib
+import hmac
+import os
+import tempfile
+import time
+from dotenv import load_dotenv
+
+from utils import UPLOAD_DIR
+
+
+load_dotenv()
+
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# room for the other form fields and the multipart framing around the image
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+# routes taking an image, their bodies are capped before the form parser spools them to disk
+UPLOAD_ROUTES = {("POST", "/messages")}
+
+# signed media URLs stay the same for this long, so the browser's immutable copy keeps being hit
+MEDIA_URL_TTL = int(os.getenv("MEDIA_URL_TTL", 7 * 24 * 3600))
+MEDIA_SIGNING_KEY = hashlib.sha256(b"media:" + os.getenv("SECRET_KEY", "").encode()).digest()
+
+TMP_DIR = UPLOAD_DIR / ".tmp"
+os.makedirs(TMP_DIR, exist_ok=True)
+
+# the extension is taken from the file's magic bytes, never from the client's filename or content type
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+)
+ALLOWED_CONTENT_TYPES = {"image/png", "image/jpeg", "image/gif", "image/webp"}
+
+
+def sniff_image(head: bytes):
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+
+def upload_url(image_hash: str, ext: str) -> str:
+    return f"/uploads/{image_hash}{ext}"
+
+
+def media_signature(path: str, exp: int) -> str:
+    digest = hmac.new(MEDIA_SIGNING_KEY, f"{path}:{exp}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:18]).decode()
+
+
+def signed_media_url(path: str | None):
+    # signed per file rather than per session, a new login or token doesn't change the URL;
+    # expiry is rounded to MEDIA_URL_TTL steps and always at least one step away
+    if not path:
+        return None
+    exp = (int(time.time()) // MEDIA_URL_TTL + 2) * MEDIA_URL_TTL
+    return f"{path}?exp={exp}&sig={media_signature(path, exp)}"
+
+
+def verify_media_url(path: str, exp: int | None, sig: str | None) -> bool:
+    if exp is None or sig is None or exp <= time.time():
+        return False
+    return hmac.compare_digest(sig, media_signature(path, exp))
+
+
+class UploadLimitMiddleware:
+    def __init__(self, app, max_body: int = MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD):
+        self.app = app
+        self.max_body = max_body
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (scope["method"], scope["path"]) not in UPLOAD_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        # turned away on the header, before a byte of the body is read
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_body:
+            await ORJSONResponse({"detail": "Image is too large"}, status_code=413)(scope, receive, send)
+            return
+
+        # chunked bodies have no length up front, they are cut off once they pass the cap
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > self.max_body:
+                raise HTTPException(status_code=413, detail="Image is too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def _finalize(tmp_path: str, final_path: str):
+    if os.path.exists(final_path):
+        # same content is already stored, keep the existing file
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, final_path)
+
+
+async def store_image(image: UploadFile):
+    if image.content_type not in ALLOWED_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail="Unsupported image type")
+    # the form parser already spooled the file, one over the limit isn't copied again
+    if image.size is not None and image.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Image is too large")
+
+    digest = hashlib.sha256()
+    size = 0
+    ext = None
+
+    fd, tmp_path = tempfile.mkstemp(dir=TMP_DIR)
+    tmp = os.fdopen(fd, "wb")
+    try:
+        while chunk := await image.read(UPLOAD_CHUNK_SIZE):
+            if ext is None:
+                ext = sniff_image(chunk[:16])
+                if ext is None:
+                    raise HTTPException(status_code=415, detail="Unsupported image type")
+
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="Image is too large")
+
+            digest.update(chunk)
+            await run_in_threadpool(tmp.write, chunk)
+
+        await run_in_threadpool(tmp.close)
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Image is empty")
+
+        image_hash = digest.hexdigest()
+        await run_in_threadpool(_finalize, tmp_path, os.path.join(UPLOAD_DIR, image_hash + ext))
+    except BaseException:
+        tmp.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return image_hash, ext
@@ -0,0 +1,100 @@
+from sqlalchemy import and_, case, func, literal, or_, select, true
+
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+import time
+
+import orjson
+
+from database import User
+
+
+USER_PAGE_DEFAULT = 20
+USER_PAGE_MAX = 100
+# shorter queries only match prefixes, a 1-2 letter substring matches most of the table and has no trigram to use
+USER_SUBSTRING_MIN_LENGTH = 3
+
+USER_SEARCH_CACHE_SIZE = int(os.getenv("USER_SEARCH_CACHE_SIZE", 2000))
+# new users show up on other workers once their pages expire, so keep this short
+USER_SEARCH_CACHE_TTL = float(os.getenv("USER_SEARCH_CACHE_TTL", 10))
+
+
+def escape_like(q: str) -> str:
+    return q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+async def search_users(db, q: str, after: tuple | None, limit: int):
+    # rows are (rank, user), prefix matches rank 0 and come before substring ones
+    username = func.lower(User.username)
+    display_name = func.lower(User.display_name)
+
+    if q:
+        prefix = escape_like(q) + "%"
+        prefix_match = or_(username.like(prefix, escape="\\"), display_name.like(prefix, escape="\\"))
+        if len(q) >= USER_SUBSTRING_MIN_LENGTH:
+            substring = "%" + escape_like(q) + "%"
+            condition = or_(username.like(substring, escape="\\"), display_name.like(substring, escape="\\"))
+            rank = case((prefix_match, 0), else_=1)
+        else:
+            condition, rank = prefix_match, literal(0)
+    else:
+        condition, rank = true(), literal(0)
+
+    statement = select(rank.label("rank"), User.id, User.username, User.display_name).where(condition)
+    if after is not None:
+        after_rank, after_username = after
+        statement = statement.where(or_(rank > after_rank, and_(rank == after_rank, User.username > after_username)))
+
+    rows = (await db.execute(statement.order_by(rank, User.username).limit(limit))).all()
+    return [(row.rank, {"id": row.id, "username": row.username, "display_name": row.display_name}) for row in rows]
+
+
+def page_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+class UserSearchCache:
+    def __init__(self, max_size: int = USER_SEARCH_CACHE_SIZE, ttl: float = USER_SEARCH_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # (q, cursor, limit) -> (body, etag, expires_at), least recently used first
+        self._pages: OrderedDict[tuple, tuple[bytes, str, float]] = OrderedDict()
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None or entry[2] <= time.monotonic():
+                self._pages.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def set(self, key: tuple, page: dict):
+        # stored rendered, a hit skips the query and the serialization both
+        body = orjson.dumps(page)
+        etag = page_etag(body)
+        with self._lock:
+            self._pages[key] = (body, etag, time.monotonic() + self.ttl)
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.max_size:
+                self._pages.popitem(last=False)
+        return body, etag
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._pages), "hits": self.hits, "misses": self.misses}
+
+
+user_search_cache = UserSearchCache()
@@ -1,5 +1,8 @@
+from fastapi import HTTPException, Request
 from fastapi.security import HTTPBearer
 
+import base64
+import json
 import os
 from pathlib import Path
 
@@ -11,3 +14,30 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 
 security = HTTPBearer()
+
+
+def encode_cursor(data: dict) -> str:
+    raw = json.dumps(data, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    return data
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
@@ -1,27 +1,359 @@
-from fastapi import WebSocket
+from fastapi import WebSocket, WebSocketDisconnect
 
-from typing import List
+import asyncio
+import json
+import os
+import time
+from collections import deque
+
+import msgpack
+
+from broker import Broker, create_broker
+from membership import membership
+from presence import PresenceTracker
+from metrics import ws_connections_opened, ws_broadcast_duration, ws_fanout_recipients, ws_delivery_lag, ws_dropped, ws_slow_disconnects
+
+
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", 256))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", 10))
+# what to do when a client's outbound queue is full: drop_oldest, coalesce or disconnect
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "coalesce")
+
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# Sec-WebSocket-Protocol values a client may ask for, without one the socket speaks JSON text frames
+WS_SUBPROTOCOLS = ("msgpack", "json")
+
+# broker channel for membership changes, chat ids start at 1 so it can't collide with a chat
+CONTROL_CHANNEL = 0
+
+
+class Payload:
+    # one per broadcast, every socket shares the encoding for its protocol
+    __slots__ = ("message", "created", "_text", "_binary")
+
+    def __init__(self, message):
+        self.message = message
+        self.created = time.perf_counter()
+        self._text = None
+        self._binary = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = json.dumps(self.message, separators=(",", ":"), ensure_ascii=False, default=str)
+        return self._text
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = msgpack.packb(self.message, use_bin_type=True, default=str)
+        return self._binary
+
+
+def choose_subprotocol(websocket: WebSocket):
+    for subprotocol in websocket.scope.get("subprotocols", []):
+        if subprotocol in WS_SUBPROTOCOLS:
+            return subprotocol
+    return None
+
+
+class Connection:
+    def __init__(
+        self,
+        websocket: WebSocket,
+        manager,
+        max_queue: int,
+        policy: str,
+        protocol: str = "json",
+        chat_id: int | None = None,
+        user_id: int | None = None,
+    ):
+        self.websocket = websocket
+        self.protocol = protocol
+        # set for /ws/chat/{chat_id} sockets, /ws sockets carry every chat of their user
+        self.chat_id = chat_id
+        self.user_id = user_id
+        # chats the client has open, ephemeral events only go to those
+        self.subscriptions: set[int] = set()
+        self.manager = manager
+        self.max_queue = max_queue
+        self.policy = policy
+        self.queue: deque[tuple] = deque()
+        self.dropped = 0
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._write())
+
+    def enqueue(self, payload: Payload, coalesce_key=None) -> bool:
+        if self.closed:
+            return False
+
+        if coalesce_key is not None and self.policy == "coalesce":
+            for i, (key, _) in enumerate(self.queue):
+                if key == coalesce_key:
+                    self.queue[i] = (coalesce_key, payload)
+                    return True
+
+        if len(self.queue) >= self.max_queue:
+            if self.policy == "disconnect":
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+            ws_dropped.inc()
+
+        self.queue.append((coalesce_key, payload))
+        self._ready.set()
+        return True
+
+    async def receive(self):
+        # clients may send either frame type, binary frames are MessagePack
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        if message.get("bytes") is not None:
+            return msgpack.unpackb(message["bytes"], raw=False)
+        return json.loads(message["text"])
+
+    async def _write(self):
+        try:
+            while True:
+                while not self.queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+
+                _, payload = self.queue.popleft()
+                if self.protocol == "msgpack":
+                    send = self.websocket.send_bytes(payload.binary)
+                else:
+                    send = self.websocket.send_text(payload.text)
+                await asyncio.wait_for(send, WS_SEND_TIMEOUT)
+                ws_delivery_lag.observe(time.perf_counter() - payload.created)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.manager.disconnect(self)
+            await self._close()
+
+    def stop(self):
+        self.closed = True
+        self.queue.clear()
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    async def _close(self, code: int = 1011):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
 
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict[int, List[WebSocket]] = {}
+    def __init__(self, broker: Broker | None = None, max_queue: int = WS_QUEUE_SIZE, policy: str = WS_SLOW_CONSUMER_POLICY):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
 
-    async def connect(self, chat_id: int, websocket: WebSocket):
-        await websocket.accept()
-        if chat_id not in self.active_connections:
-            self.active_connections[chat_id] = []
-        self.active_connections[chat_id].append(websocket)
+        self.broker = broker or create_broker()
+        self.max_queue = max_queue
+        self.policy = policy
+        # /ws/chat/{chat_id} sockets by chat
+        self.active_connections: dict[int, dict[WebSocket, Connection]] = {}
+        # /ws sockets by user, plus the chats routed to each connected user and the reverse
+        self.user_connections: dict[int, dict[WebSocket, Connection]] = {}
+        self.user_chats: dict[int, set[int]] = {}
+        self.chat_users: dict[int, set[int]] = {}
+        self.presence = PresenceTracker(self)
+        # called with every event published on another node, for caches to apply writes they didn't see
+        self.remote_listeners: list = []
 
-    def disconnect(self, chat_id: int, websocket: WebSocket):
-        self.active_connections[chat_id].remove(websocket)
-        if not self.active_connections[chat_id]:
-            del self.active_connections[chat_id]
+    async def start(self):
+        await self.broker.start(self._receive)
+        self.broker.subscribe(CONTROL_CHANNEL)
+        self.presence.start()
 
-    async def broadcast(self, chat_id: int, message: dict):
-        if chat_id in self.active_connections:
-            for connection in self.active_connections[chat_id]:
-                await connection.send_json(message)
+    async def stop(self):
+        await self.presence.stop()
+        await self.broker.stop()
 
-manager = ConnectionManager()
+    async def connect(self, chat_id: int, websocket: WebSocket, user_id: int | None = None) -> Connection:
+        connection = await self._accept(websocket, chat_id=chat_id, user_id=user_id)
+        self._watch(chat_id)
+        self.active_connections.setdefault(chat_id, {})[websocket] = connection
+        ws_connections_opened.inc()
+        if user_id is not None:
+            self.presence.socket_opened(user_id)
+        return connection
+
+    async def connect_user(self, user_id: int, websocket: WebSocket, chat_ids) -> Connection:
+        connection = await self._accept(websocket, user_id=user_id)
+        sockets = self.user_connections.setdefault(user_id, {})
+        if not sockets:
+            self.user_chats[user_id] = set()
+            for chat_id in chat_ids:
+                self._route(chat_id, user_id)
+        sockets[websocket] = connection
+        ws_connections_opened.inc()
+        self.presence.socket_opened(user_id)
+        return connection
+
+    def disconnect(self, connection: Connection):
+        connection.stop()
 
+        if connection.chat_id is not None:
+            connections = self.active_connections.get(connection.chat_id)
+            if connections is None or connections.pop(connection.websocket, None) is None:
+                return
+            if not connections:
+                del self.active_connections[connection.chat_id]
+                self._unwatch(connection.chat_id)
+            if connection.user_id is not None:
+                self.presence.socket_closed(connection.user_id)
+            return
+
+        sockets = self.user_connections.get(connection.user_id)
+        if sockets is None or sockets.pop(connection.websocket, None) is None:
+            return
+        self.presence.socket_closed(connection.user_id)
+        if not sockets:
+            del self.user_connections[connection.user_id]
+            for chat_id in self.user_chats.pop(connection.user_id, ()):
+                self._unroute(chat_id, connection.user_id)
+
+    def routes(self, user_id: int, chat_id) -> bool:
+        return chat_id in self.user_chats.get(user_id, ())
+
+    def subscribe(self, connection: Connection, chat_id: int) -> bool:
+        if not self.routes(connection.user_id, chat_id):
+            return False
+        connection.subscriptions.add(chat_id)
+        return True
+
+    def unsubscribe(self, connection: Connection, chat_id: int):
+        connection.subscriptions.discard(chat_id)
+
+    async def add_chat(self, chat_id: int, user_ids):
+        # a chat created after its members connected, every node routes it to the members it holds
+        self._add_chat(chat_id, user_ids)
+        await self.broker.publish(CONTROL_CHANNEL, {"action": "chat_added", "chat_id": chat_id, "user_ids": list(user_ids)})
+
+    async def remove_user(self, user_id: int):
+        self._remove_user(user_id)
+        await self.broker.publish(CONTROL_CHANNEL, {"action": "user_removed", "user_id": user_id})
+
+    def send_to(self, connection: Connection, message: dict):
+        if not connection.enqueue(Payload(message)):
+            ws_slow_disconnects.inc()
+            self.disconnect(connection)
+            asyncio.create_task(connection._close(code=1013))
+
+    async def typing(self, chat_id: int, user_id: int, typing: bool = True):
+        event = self.presence.typing_event(chat_id, user_id, typing)
+        if event is not None:
+            # the typer's own sockets, here and on other nodes, don't show them their own indicator
+            await self.broadcast(chat_id, event, ("typing", chat_id, user_id), ephemeral=True, skip_user=user_id)
+
+    async def publish_control(self, message: dict):
+        await self.broker.publish(CONTROL_CHANNEL, message)
+
+    def send_to_chats(self, chat_ids, message: dict, coalesce_key=None, skip_user: int | None = None):
+        # one frame per local socket routed any of the chats, for events about a user rather than a chat
+        targets = {}
+        for chat_id in chat_ids:
+            targets.update((id(c), c) for c in self.active_connections.get(chat_id, {}).values())
+            for user_id in self.chat_users.get(chat_id, ()):
+                targets.update((id(c), c) for c in self.user_connections.get(user_id, {}).values())
+        self._enqueue([c for c in targets.values() if c.user_id != skip_user], Payload(message), coalesce_key)
+
+    async def broadcast(self, chat_id: int, message: dict, coalesce_key=None, ephemeral: bool = False, skip_user: int | None = None):
+        self.deliver(chat_id, message, coalesce_key, ephemeral, skip_user)
+        await self.broker.publish(chat_id, message, coalesce_key, ephemeral, skip_user)
+
+    def deliver(self, chat_id: int, message: dict, coalesce_key=None, ephemeral: bool = False, skip_user: int | None = None):
+        if chat_id == CONTROL_CHANNEL:
+            self._control(message)
+            return
+
+        self.presence.observe(chat_id, message)
+
+        # only enqueues, every socket is drained by its own writer task
+        payload = Payload(message)
+        targets = list(self.active_connections.get(chat_id, {}).values())
+        for user_id in self.chat_users.get(chat_id, ()):
+            for connection in self.user_connections.get(user_id, {}).values():
+                # messages reach every chat of the user, typing and other ephemera only the open ones
+                if not ephemeral or chat_id in connection.subscriptions:
+                    targets.append(connection)
+        if skip_user is not None:
+            targets = [connection for connection in targets if connection.user_id != skip_user]
+        self._enqueue(targets, payload, coalesce_key)
+
+    def _receive(self, chat_id: int, message, coalesce_key=None, ephemeral: bool = False, skip_user: int | None = None):
+        if not ephemeral:
+            for listener in self.remote_listeners:
+                listener(chat_id, message)
+        self.deliver(chat_id, message, coalesce_key, ephemeral, skip_user)
+
+    def _enqueue(self, targets: list[Connection], payload: Payload, coalesce_key=None):
+        slow = [connection for connection in targets if not connection.enqueue(payload, coalesce_key)]
+        ws_broadcast_duration.observe(time.perf_counter() - payload.created)
+        ws_fanout_recipients.observe(len(targets))
+
+        for connection in slow:
+            ws_slow_disconnects.inc()
+            self.disconnect(connection)
+            # 1013: try again later
+            asyncio.create_task(connection._close(code=1013))
+
+    async def _accept(self, websocket: WebSocket, **kwargs) -> Connection:
+        subprotocol = choose_subprotocol(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        return Connection(websocket, self, self.max_queue, self.policy, subprotocol or "json", **kwargs)
+
+    def _control(self, message: dict):
+        # from another node, which already updated its own membership index
+        if message.get("action") == "chat_added":
+            membership.add_chat(message["chat_id"], message["user_ids"])
+            self._add_chat(message["chat_id"], message["user_ids"])
+        elif message.get("action") == "user_removed":
+            membership.remove_user(message["user_id"])
+            self._remove_user(message["user_id"])
+        elif message.get("action") == "presence":
+            self.presence.on_control(message)
+
+    def _add_chat(self, chat_id: int, user_ids):
+        for user_id in user_ids:
+            if user_id in self.user_connections:
+                self._route(chat_id, user_id)
+
+    def _remove_user(self, user_id: int):
+        connections = list(self.user_connections.get(user_id, {}).values())
+        connections += [c for sockets in self.active_connections.values() for c in sockets.values() if c.user_id == user_id]
+        for connection in connections:
+            self.disconnect(connection)
+            asyncio.create_task(connection._close(code=1008))
+
+    def _route(self, chat_id: int, user_id: int):
+        self._watch(chat_id)
+        self.user_chats[user_id].add(chat_id)
+        self.chat_users.setdefault(chat_id, set()).add(user_id)
+
+    def _unroute(self, chat_id: int, user_id: int):
+        users = self.chat_users.get(chat_id)
+        if users is None:
+            return
+        users.discard(user_id)
+        if not users:
+            del self.chat_users[chat_id]
+            self._unwatch(chat_id)
+
+    def _watch(self, chat_id: int):
+        # the broker only forwards chats someone on this node can receive
+        if chat_id not in self.active_connections and chat_id not in self.chat_users:
+            self.broker.subscribe(chat_id)
+
+    def _unwatch(self, chat_id: int):
+        if chat_id not in self.active_connections and chat_id not in self.chat_users:
+            self.broker.unsubscribe(chat_id)
+
+
+manager = ConnectionManager()
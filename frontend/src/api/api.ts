@@ -26,8 +26,9 @@ privateApi.interceptors.request.use((config) => {
 });
 
 // messages
-export const fetchMessages = (chatId: number) =>
-    privateApi.get("/messages", { params: { chat_id: chatId } }).then((r) => r.data.messages);
+// newest page first, pass cursors.before back to page further into history
+export const fetchMessages = (chatId: number, cursor?: string | null) =>
+    privateApi.get("/messages", { params: { chat_id: chatId, cursor: cursor || undefined } }).then((r) => r.data);
 
 export const postMessage = (formData: FormData) =>
     privateApi.post("/messages", formData, {
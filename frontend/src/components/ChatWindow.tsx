@@ -1,4 +1,4 @@
-import { useEffect, useRef, useState } from "react";
+import { useEffect, useLayoutEffect, useRef, useState } from "react";
 import TextareaAutosize from "react-textarea-autosize";
 import Loader from "./Loader";
 import { fetchMessages, postMessage, deleteMessage as apiDeleteMessage, patchMessage } from "../api/api";
@@ -42,12 +42,25 @@ const ChatWindow = ({ chat }: { chat: ChatProps }) => {
     const [isReplying, setIsReplying] = useState<boolean>(false);
     const [replyedMessageContent, setReplyedMessageContent] = useState<string | null>(null);
 
+    // cursor to the page before the oldest loaded message, null once the start of the chat is loaded
+    const [olderCursor, setOlderCursor] = useState<string | null>(null);
+    const [loadingOlder, setLoadingOlder] = useState(false);
+
     const messagesEndRef = useRef<HTMLDivElement>(null);
+    const messagesBoxRef = useRef<HTMLDivElement>(null);
+    // scroll height before older messages were prepended, so the view stays where it was
+    const prependedFromRef = useRef<number | null>(null);
     const scrollToBottom = () => {
         messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
     };
 
-    useEffect(() => {
+    useLayoutEffect(() => {
+        const box = messagesBoxRef.current;
+        if (box && prependedFromRef.current !== null) {
+            box.scrollTop = box.scrollHeight - prependedFromRef.current;
+            prependedFromRef.current = null;
+            return;
+        }
         scrollToBottom();
     }, [messages]);
 
@@ -60,10 +73,14 @@ const ChatWindow = ({ chat }: { chat: ChatProps }) => {
 
         const fetch = async () => {
             setLoading(true);
+            setOlderCursor(null);
             await new Promise((r) => setTimeout(r, 300));
             try {
-                const msgs = await fetchMessages(chat.chatId);
-                if (isMounted) setMessages(msgs);
+                const page = await fetchMessages(chat.chatId);
+                if (isMounted) {
+                    setMessages(page.messages);
+                    setOlderCursor(page.has_more ? page.cursors.before : null);
+                }
             } catch (err) {
                 console.error(err);
             } finally {
@@ -78,6 +95,25 @@ const ChatWindow = ({ chat }: { chat: ChatProps }) => {
         };
     }, [chat.chatId]);
 
+    const loadOlder = async () => {
+        if (!olderCursor || loadingOlder) return;
+
+        setLoadingOlder(true);
+        try {
+            const page = await fetchMessages(chat.chatId, olderCursor);
+            prependedFromRef.current = messagesBoxRef.current?.scrollHeight ?? null;
+            setMessages((prev) => {
+                const loaded = new Set(prev.map((m) => m.id));
+                return [...page.messages.filter((m: Message) => !loaded.has(m.id)), ...prev];
+            });
+            setOlderCursor(page.has_more ? page.cursors.before : null);
+        } catch (err) {
+            console.error(err);
+        } finally {
+            setLoadingOlder(false);
+        }
+    };
+
     useEffect(() => {
         if (!socket) return;
 
@@ -85,6 +121,9 @@ const ChatWindow = ({ chat }: { chat: ChatProps }) => {
             try {
                 const data = JSON.parse(event.data);
 
+                // the socket carries every chat of the user plus acks and other control frames
+                if (Number(data.chat_id) !== Number(chat.chatId)) return;
+
                 if (data.action === "delete_message") {
                     setMessages((prev) => prev.filter((m) => m.id !== data.message_id));
                     return;
@@ -97,6 +136,8 @@ const ChatWindow = ({ chat }: { chat: ChatProps }) => {
                     return;
                 }
 
+                if (data.action !== undefined) return;
+
                 setMessages((prev) => [
                     ...prev,
                     {
@@ -104,7 +145,7 @@ const ChatWindow = ({ chat }: { chat: ChatProps }) => {
                         sender: {
                             id: data.sender_id,
                             username: data.sender_username,
-                            display_name: data.sender_displayName,
+                            display_name: data.sender_display_name,
                         },
                     } as unknown as Message,
                 ]);
@@ -115,7 +156,7 @@ const ChatWindow = ({ chat }: { chat: ChatProps }) => {
 
         socket.addEventListener("message", handler);
         return () => socket.removeEventListener("message", handler);
-    }, [socket]);
+    }, [socket, chat.chatId]);
 
     const handleSend = async () => {
         const token = localStorage.getItem("accessToken");
@@ -182,7 +223,18 @@ const ChatWindow = ({ chat }: { chat: ChatProps }) => {
                         </div>
                     </div>
 
-                    <div className="flex flex-col justify-items-start w-full h-full p-3 gap-2 overflow-y-auto custom-scroll">
+                    <div
+                        ref={messagesBoxRef}
+                        onScroll={(e) => {
+                            if (e.currentTarget.scrollTop === 0) loadOlder();
+                        }}
+                        className="flex flex-col justify-items-start w-full h-full p-3 gap-2 overflow-y-auto custom-scroll"
+                    >
+                        {olderCursor && (
+                            <button onClick={loadOlder} disabled={loadingOlder} className="self-center text-xs text-white/50 hover:text-white/75">
+                                {loadingOlder ? "Loading..." : "Load earlier messages"}
+                            </button>
+                        )}
                         {messages.map((msg) => (
                             <div key={msg.id} className={`flex ${msg.sender?.id === chat.userId ? "flex-row" : "flex-row-reverse"} gap-3`}>
                                 <div className={`flex flex-col gap-1 ${msg.sender?.id === chat.userId ? "bg-[#313640] items-start self-start px-3 py-2 other-message max-w-[50%]" : "bg-[#9371EB] items-end self-end px-3 py-2 my-message max-w-[50%]"}`}>
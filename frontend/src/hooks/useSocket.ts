@@ -5,20 +5,25 @@ type UseSocketOpts = {
     wsBase?: string;
 };
 
+// one /ws socket per user, the open chat is picked with subscribe/unsubscribe frames
 export const useSocket = (chatId: number | string, opts?: UseSocketOpts) => {
     const wsRef = useRef<WebSocket | null>(null);
+    const chatIdRef = useRef(chatId);
     const [connected, setConnected] = useState(false);
 
     useEffect(() => {
         const wsBase = opts?.wsBase || process.env.REACT_APP_WS_URL || "ws://localhost:5050";
         const token = opts?.getToken ? opts.getToken() : localStorage.getItem("accessToken");
         const tokenPart = token ? `?token=${encodeURIComponent(token)}` : "";
-        const url = `${wsBase}/ws/chat/${chatId}${tokenPart}`;
+        const url = `${wsBase}/ws${tokenPart}`;
 
         const ws = new WebSocket(url);
         wsRef.current = ws;
 
-        ws.onopen = () => setConnected(true);
+        ws.onopen = () => {
+            ws.send(JSON.stringify({ action: "subscribe", chat_id: Number(chatIdRef.current) }));
+            setConnected(true);
+        };
         ws.onclose = () => setConnected(false);
         ws.onerror = (e) => {
             console.error("WebSocket error", e);
@@ -28,15 +33,24 @@ export const useSocket = (chatId: number | string, opts?: UseSocketOpts) => {
             ws.close();
             wsRef.current = null;
         };
-    }, [chatId, opts?.getToken, opts?.wsBase]);
+    }, [opts?.getToken, opts?.wsBase]);
+
+    useEffect(() => {
+        const ws = wsRef.current;
+        if (ws?.readyState === WebSocket.OPEN && chatIdRef.current !== chatId) {
+            ws.send(JSON.stringify({ action: "unsubscribe", chat_id: Number(chatIdRef.current) }));
+            ws.send(JSON.stringify({ action: "subscribe", chat_id: Number(chatId) }));
+        }
+        chatIdRef.current = chatId;
+    }, [chatId]);
 
     const sendMessage = (payload: any) => {
         if (wsRef.current?.readyState === WebSocket.OPEN) {
-            wsRef.current.send(JSON.stringify(payload));
+            wsRef.current.send(JSON.stringify({ chat_id: Number(chatIdRef.current), ...payload }));
         } else {
             console.warn("Socket is not open");
         }
     };
 
     return { socket: wsRef.current, connected, sendMessage };
-};
\ No newline at end of file
+};